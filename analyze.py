@@ -0,0 +1,505 @@
+"""Offline analysis of a capture.
+
+Catch napari performance regressions without a browser. Record a run with
+--capture_path, see capture.py, then:
+
+    python webmon.py analyze run.jsonl --json_path run.json \\
+        --html_path run.html --baseline baseline.json
+
+We report:
+
+    frames - Frame time percentiles and hitches, see hitches.py.
+    loads  - Load throughput in MB/s, and load_ms percentiles overall and
+             by chunk size, in power of two size buckets.
+    tiles  - Churn of the seen tiles, how many tiles appeared or vanished
+             from one tile_state to the next.
+
+With a baseline we compare the METRICS and fail if any got worse by more
+than its threshold, so "analyze" can run in CI.
+
+Captures can be many GB, so we read CHUNK_RECORDS records at a time and
+compute each chunk's statistics with numpy. We keep only histograms and
+counters between chunks, so memory does not grow with the capture.
+
+We analyze one session at a time, so a capture of several sessions needs
+--session to pick one.
+"""
+import html
+import json
+import logging
+import math
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+from hitches import HitchDetector
+from lib.histogram import Histogram
+
+LOGGER = logging.getLogger("webmon")
+
+# Number of records we read and process at a time.
+CHUNK_RECORDS = 100_000
+
+# We give the HitchDetector this many frames at a time, about what webmon
+# gives it per tick, so the baseline keeps up with the frames it judges.
+HITCH_SLICE_FRAMES = 10
+
+# The metrics we compare against a baseline, as (name, path in the report,
+# higher_is_worse).
+METRICS = [
+    ("frame_ms.p50", ("frames", "frame_ms", "p50"), True),
+    ("frame_ms.p90", ("frames", "frame_ms", "p90"), True),
+    ("frame_ms.p99", ("frames", "frame_ms", "p99"), True),
+    ("hitches_per_1000_frames", ("frames", "hitches_per_1000_frames"), True),
+    ("load_ms.p50", ("loads", "load_ms", "p50"), True),
+    ("load_ms.p90", ("loads", "load_ms", "p90"), True),
+    ("load_mb_per_s", ("loads", "load_mb_per_s"), False),
+]
+
+# Fail if a metric is this many percent worse than the baseline.
+DEFAULT_MAX_REGRESSION = 10.0
+
+
+def read_chunks(
+    path: str, session: Optional[str] = None, chunk_records=CHUNK_RECORDS
+) -> Iterator[Dict[str, List[dict]]]:
+    """Yield the capture's records a chunk at a time.
+
+    Parameters
+    ----------
+    path : str
+        The capture file.
+    session : Optional[str]
+        Only yield this session's records. If None the capture must only
+        have one session.
+    chunk_records : int
+        The number of records in each chunk.
+
+    Return
+    ------
+    Iterator[Dict[str, List[dict]]]
+        The data of each record in the chunk, by stream.
+
+    Raises
+    ------
+    ValueError
+        If session is None and the capture has several sessions.
+    """
+    chunk = defaultdict(list)
+    count = 0
+    sessions = set()
+    with open(path) as infile:
+        for line_number, line in enumerate(infile, 1):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # The last line is cut off if webmon was killed.
+                LOGGER.warning("%s:%d: bad record", path, line_number)
+                continue
+
+            record_session = record.get('session')
+            if session is None:
+                sessions.add(record_session)
+                if len(sessions) > 1:
+                    raise ValueError(
+                        f"{path} has sessions {sorted(map(str, sessions))}, "
+                        "pick one with --session"
+                    )
+            elif record_session != session:
+                continue
+
+            chunk[record['stream']].append(record['data'])
+            count += 1
+            if count == chunk_records:
+                yield chunk
+                chunk = defaultdict(list)
+                count = 0
+
+    if count:
+        yield chunk
+
+
+def _columns(records: List[dict], fields: List[str]) -> Dict[str, np.ndarray]:
+    """Return the fields of the records as float64 columns."""
+    return {
+        field: np.fromiter(
+            (record.get(field, 0) for record in records),
+            dtype=np.float64,
+            count=len(records),
+        )
+        for field in fields
+    }
+
+
+class FrameStats:
+    """Frame time percentiles and hitches."""
+
+    def __init__(self):
+        self.frame_ms = Histogram("frame_ms")
+        self.hitches = HitchDetector()
+
+    def add(self, frame_time: List[dict], load_chunk: List[dict]) -> None:
+        frames = _columns(frame_time, ["time", "delta_ms"])
+        loads = _columns(load_chunk, ["time", "load_ms", "num_bytes"])
+        self.frame_ms.record_many(frames["delta_ms"])
+
+        # Give the detector each slice of frames with the loads up to the
+        # slice's last frame, like webmon does live.
+        order = np.argsort(loads["time"], kind="stable")
+        loads = {name: column[order] for name, column in loads.items()}
+        load_start = 0
+        for start in range(0, len(frame_time), HITCH_SLICE_FRAMES):
+            end = start + HITCH_SLICE_FRAMES
+            frame_slice = {
+                name: column[start:end] for name, column in frames.items()
+            }
+            load_end = np.searchsorted(
+                loads["time"], frame_slice["time"].max(), side="right"
+            )
+            self.hitches.process(
+                frame_slice,
+                {
+                    name: column[load_start:load_end]
+                    for name, column in loads.items()
+                },
+            )
+            load_start = load_end
+
+        # Loads after the last frame count for the next chunk's frames.
+        self.hitches.process(
+            {}, {name: column[load_start:] for name, column in loads.items()}
+        )
+
+    def as_dict(self) -> dict:
+        count = self.frame_ms.count
+        per_1000 = 1000 * self.hitches.num_hitches / count if count else 0.0
+        return {
+            'count': count,
+            'frame_ms': self.frame_ms.as_dict(),
+            'hitches': self.hitches.num_hitches,
+            'hitches_per_1000_frames': per_1000,
+        }
+
+
+class LoadStats:
+    """Load throughput and load_ms by chunk size."""
+
+    def __init__(self):
+        self.load_ms = Histogram("load_ms")
+        self.by_size: Dict[int, Histogram] = {}
+        self.num_bytes = 0
+        self.total_load_ms = 0.0
+        self.first_time = math.inf
+        self.last_time = -math.inf
+
+    def add(self, load_chunk: List[dict]) -> None:
+        if not load_chunk:
+            return
+        loads = _columns(load_chunk, ["time", "load_ms", "num_bytes"])
+        load_ms = loads["load_ms"]
+        num_bytes = loads["num_bytes"]
+
+        self.load_ms.record_many(load_ms)
+        self.num_bytes += int(num_bytes.sum())
+        self.total_load_ms += float(load_ms.sum())
+        self.first_time = min(self.first_time, float(loads["time"].min()))
+        self.last_time = max(self.last_time, float(loads["time"].max()))
+
+        # Bucket k holds chunks of [2**k, 2**(k+1)) bytes.
+        buckets = np.floor(np.log2(np.maximum(num_bytes, 1))).astype(int)
+        for bucket in np.unique(buckets):
+            histogram = self.by_size.setdefault(
+                int(bucket), Histogram(f"load_ms_{bucket}")
+            )
+            histogram.record_many(load_ms[buckets == bucket])
+
+    def as_dict(self) -> dict:
+        megabytes = self.num_bytes / 1e6
+        load_seconds = self.total_load_ms / 1000
+        wall_seconds = max(self.last_time - self.first_time, 0)
+        return {
+            'count': self.load_ms.count,
+            'bytes': self.num_bytes,
+            'load_ms': self.load_ms.as_dict(),
+            # While loading, and over the whole capture.
+            'load_mb_per_s': megabytes / load_seconds if load_seconds else 0,
+            'wall_mb_per_s': megabytes / wall_seconds if wall_seconds else 0,
+            'by_size': [
+                {
+                    'min_bytes': 2 ** bucket,
+                    'max_bytes': 2 ** (bucket + 1),
+                    **self.by_size[bucket].as_dict(),
+                }
+                for bucket in sorted(self.by_size)
+            ],
+        }
+
+
+class TileChurn:
+    """How many seen tiles change from one tile_state to the next."""
+
+    def __init__(self):
+        self.churn = Histogram("tile_churn")
+        self.added = 0
+        self.removed = 0
+        self._previous = np.zeros(0, dtype=np.int64)
+
+    def add(self, tile_states: List[dict]) -> None:
+        churn = np.zeros(len(tile_states))
+        for i, tile_state in enumerate(tile_states):
+            seen = _tile_keys(tile_state)
+            added = len(np.setdiff1d(seen, self._previous, True))
+            removed = len(np.setdiff1d(self._previous, seen, True))
+            self.added += added
+            self.removed += removed
+            churn[i] = added + removed
+            self._previous = seen
+        self.churn.record_many(churn)
+
+    def as_dict(self) -> dict:
+        return {
+            'updates': self.churn.count,
+            'added': self.added,
+            'removed': self.removed,
+            'churn': self.churn.as_dict(),
+        }
+
+
+def _tile_keys(tile_state: dict) -> np.ndarray:
+    """Return one unique int64 key per seen tile, sorted."""
+    seen = np.asarray(tile_state.get('seen', []), dtype=np.int64)
+    seen = seen.reshape(-1, 2)
+    level = np.int64(tile_state.get('level_index', 0))
+    return np.unique((level << 42) | (seen[:, 0] << 21) | seen[:, 1])
+
+
+def analyze(path: str, session: Optional[str] = None) -> dict:
+    """Return the report for this capture.
+
+    Parameters
+    ----------
+    path : str
+        The capture file.
+    session : Optional[str]
+        Only analyze this session, or every record if None.
+    """
+    frames = FrameStats()
+    loads = LoadStats()
+    tiles = TileChurn()
+
+    for chunk in read_chunks(path, session):
+        frames.add(chunk["frame_time"], chunk["load_chunk"])
+        loads.add(chunk["load_chunk"])
+        tiles.add(chunk["tile_state"])
+
+    return {
+        'capture': path,
+        'session': session,
+        'frames': frames.as_dict(),
+        'loads': loads.as_dict(),
+        'tiles': tiles.as_dict(),
+    }
+
+
+def _metric(report: dict, path: tuple) -> Optional[float]:
+    """Return the value at this path in the report, None if not there."""
+    value = report
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare(
+    report: dict, baseline: dict, thresholds: Dict[str, float]
+) -> List[dict]:
+    """Compare the METRICS of the report against the baseline.
+
+    Parameters
+    ----------
+    report : dict
+        The report of this run.
+    baseline : dict
+        The report of the run we compare against.
+    thresholds : Dict[str, float]
+        The max regression in percent of each metric.
+
+    Return
+    ------
+    List[dict]
+        One check per metric, with "passed" False if it regressed more
+        than its threshold. The regression_percent is None if the
+        baseline was zero, then any regression fails.
+    """
+    checks = []
+    for name, path, higher_is_worse in METRICS:
+        value = _metric(report, path)
+        base = _metric(baseline, path)
+        if value is None or base is None:
+            continue  # Nothing to compare, like no loads.
+
+        threshold = thresholds.get(name, DEFAULT_MAX_REGRESSION)
+        worse = value - base if higher_is_worse else base - value
+        if base:
+            regression = 100 * worse / abs(base)
+            passed = regression <= threshold
+        else:
+            # No percent of zero, like hitches when the baseline had none.
+            regression = None
+            passed = worse <= 0
+
+        checks.append(
+            {
+                'metric': name,
+                'value': value,
+                'baseline': base,
+                'regression_percent': regression,
+                'threshold_percent': threshold,
+                'passed': passed,
+            }
+        )
+    return checks
+
+
+def _table(rows: List[dict]) -> str:
+    """Return the rows as an HTML table."""
+    if not rows:
+        return "<p>None.</p>"
+
+    def cell(value) -> str:
+        if isinstance(value, float):
+            value = f"{value:.3f}"
+        return f"<td>{html.escape(str(value))}</td>"
+
+    head = "".join(f"<th>{html.escape(key)}</th>" for key in rows[0])
+    body = "".join(
+        "<tr>" + "".join(cell(value) for value in row.values()) + "</tr>"
+        for row in rows
+    )
+    return f"<table><tr>{head}</tr>{body}</table>"
+
+
+def to_html(report: dict, checks: Optional[List[dict]]) -> str:
+    """Return a static HTML page for the report.
+
+    Parameters
+    ----------
+    report : dict
+        The report from analyze().
+    checks : Optional[List[dict]]
+        The checks from compare() if we compared against a baseline.
+    """
+    frames = report['frames']
+    loads = report['loads']
+    tiles = report['tiles']
+
+    summary = [
+        {'metric': name, 'value': _metric(report, path)}
+        for name, path, _ in METRICS
+    ] + [
+        {'metric': 'frames', 'value': frames['count']},
+        {'metric': 'hitches', 'value': frames['hitches']},
+        {'metric': 'loads', 'value': loads['count']},
+        {'metric': 'wall_mb_per_s', 'value': loads['wall_mb_per_s']},
+        {'metric': 'tiles added', 'value': tiles['added']},
+        {'metric': 'tiles removed', 'value': tiles['removed']},
+    ]
+    histograms = [
+        {'name': name, **values}
+        for name, values in [
+            ("frame_ms", frames['frame_ms']),
+            ("load_ms", loads['load_ms']),
+            ("tile_churn", tiles['churn']),
+        ]
+    ]
+
+    sections = [
+        f"<h1>webmon report: {html.escape(report['capture'])}</h1>",
+        "<h2>Summary</h2>",
+        _table(summary),
+        "<h2>Distributions</h2>",
+        _table(histograms),
+        "<h2>load_ms by chunk size</h2>",
+        _table(loads['by_size']),
+    ]
+    if checks is not None:
+        passed = all(check['passed'] for check in checks)
+        sections += [
+            f"<h2>Baseline: {'PASS' if passed else 'FAIL'}</h2>",
+            _table(checks),
+        ]
+
+    style = (
+        "body { font-family: sans-serif; } "
+        "table { border-collapse: collapse; } "
+        "td, th { border: 1px solid #ccc; padding: 2px 8px; } "
+    )
+    return (
+        f"<!DOCTYPE html><html><head><meta charset='utf-8'>"
+        f"<title>webmon report</title><style>{style}</style></head>"
+        f"<body>{''.join(sections)}</body></html>\n"
+    )
+
+
+def run_analysis(
+    capture_path: str,
+    json_path: Optional[str] = None,
+    html_path: Optional[str] = None,
+    baseline_path: Optional[str] = None,
+    thresholds: Optional[Dict[str, float]] = None,
+    session: Optional[str] = None,
+) -> bool:
+    """Analyze the capture, write the reports, return False on regression.
+
+    Parameters
+    ----------
+    capture_path : str
+        The capture file.
+    json_path : Optional[str]
+        Write the JSON report here, or print it if None.
+    html_path : Optional[str]
+        Write the HTML report here if given.
+    baseline_path : Optional[str]
+        Compare against the JSON report of an earlier run.
+    thresholds : Optional[Dict[str, float]]
+        The max regression in percent by metric name.
+    session : Optional[str]
+        Only analyze this session.
+    """
+    report = analyze(capture_path, session)
+
+    checks = None
+    if baseline_path is not None:
+        with open(baseline_path) as infile:
+            baseline = json.load(infile)
+        checks = compare(report, baseline, thresholds or {})
+        report['baseline'] = {'path': baseline_path, 'checks': checks}
+
+    text = json.dumps(report, indent=4, allow_nan=False)
+    if json_path is None:
+        print(text)
+    else:
+        with open(json_path, "w") as outfile:
+            outfile.write(text + "\n")
+
+    if html_path is not None:
+        with open(html_path, "w") as outfile:
+            outfile.write(to_html(report, checks))
+
+    if checks is None:
+        return True
+
+    for check in checks:
+        if not check['passed']:
+            regression = check['regression_percent']
+            LOGGER.error(
+                "%s regressed %s (%s -> %s), threshold %.1f%%",
+                check['metric'],
+                "from zero" if regression is None else f"{regression:.1f}%",
+                check['baseline'],
+                check['value'],
+                check['threshold_percent'],
+            )
+    return all(check['passed'] for check in checks)
@@ -0,0 +1,214 @@
+"""ClientQueues class.
+
+Per-client send queues so one slow web client does not slow down the rest.
+
+A backgrounded browser tab or a client on a slow link cannot keep up with
+60Hz frames. Rather than letting engine.io buffer an unbounded number of
+packets for it, we look at how many packets are still waiting in its
+engine.io queue, and hold packets back in our own small outbox until it
+drains. How we hold them depends on the stream's policy:
+
+    latest      - For state streams, only the newest packet matters.
+    drop_oldest - For event streams, keep a bounded number of packets.
+
+We never let a client's engine.io queue get much deeper than
+MAX_IN_FLIGHT, so we can't spot a stuck client by its depth. Instead a
+client is stalled while we hold packets for it but cannot send it any.
+A client stalled for longer than DISCONNECT_SECONDS is disconnected.
+"""
+import logging
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from lib.memory import encoded_size
+
+LOGGER = logging.getLogger("webmon")
+
+POLICY_LATEST = "latest"
+POLICY_DROP_OLDEST = "drop_oldest"
+
+# The policy for each stream, streams not listed use DEFAULT_POLICY.
+STREAM_POLICIES = {
+    'set_layer_data': POLICY_LATEST,
+    'chart_data': POLICY_DROP_OLDEST,
+    'stream_state': POLICY_DROP_OLDEST,
+    'napari_message': POLICY_DROP_OLDEST,
+    'hitch': POLICY_DROP_OLDEST,
+}
+DEFAULT_POLICY = POLICY_DROP_OLDEST
+
+# Hold packets back once this many are waiting in the engine.io queue.
+MAX_IN_FLIGHT = 4
+
+# Most packets we hold for one client for a drop_oldest stream.
+MAX_PENDING_EVENTS = 32
+
+# Disconnect a client we could not send anything to for this long.
+DISCONNECT_SECONDS = 10
+
+
+class ClientStats:
+    """Metrics for one client."""
+
+    def __init__(self):
+        self.sent = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def as_dict(self) -> dict:
+        return {
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'max_depth': self.max_depth,
+        }
+
+
+class ClientOutbox:
+    """Packets waiting to be sent to one client.
+
+    Attributes
+    ----------
+    latest : Dict[str, object]
+        For POLICY_LATEST streams the newest packet of each stream.
+    events : deque
+        For POLICY_DROP_OLDEST streams, bounded so the oldest drop out.
+    stalled_since : Optional[float]
+        Since when we have held packets for the client without sending it
+        any, None if we are not holding any or are still sending.
+    """
+
+    def __init__(self):
+        self.latest: Dict[str, object] = {}
+        self.events = deque()
+        self.stats = ClientStats()
+        self.stalled_since: Optional[float] = None
+
+    def put(self, stream: str, encoded) -> None:
+        """Queue this packet according to the stream's policy."""
+        policy = STREAM_POLICIES.get(stream, DEFAULT_POLICY)
+        if policy == POLICY_LATEST:
+            if stream in self.latest:
+                self.stats.dropped += 1  # Superseded.
+            self.latest[stream] = encoded
+        else:
+            if len(self.events) == MAX_PENDING_EVENTS:
+                self.events.popleft()
+                self.stats.dropped += 1
+            self.events.append(encoded)
+
+    def pop(self):
+        """Return the next packet to send or None if there are none.
+
+        Events go first, they were queued before the latest state.
+        """
+        if self.events:
+            return self.events.popleft()
+        if self.latest:
+            stream = next(iter(self.latest))
+            return self.latest.pop(stream)
+        return None
+
+    @property
+    def pending(self) -> int:
+        return len(self.events) + len(self.latest)
+
+    @property
+    def pending_bytes(self) -> int:
+        packets = list(self.events) + list(self.latest.values())
+        return sum(encoded_size(encoded) for encoded in packets)
+
+
+class ClientQueues:
+    """Outboxes for all web clients.
+
+    Parameters
+    ----------
+    send : Callable
+        Called as send(server, sid, encoded) to actually send a packet.
+    """
+
+    def __init__(self, send):
+        self._send = send
+        self._outboxes: Dict[str, ClientOutbox] = {}
+
+    def remove(self, sid: str) -> None:
+        """Forget this client, it disconnected."""
+        self._outboxes.pop(sid, None)
+
+    def put(self, server, sid: str, stream: str, encoded) -> None:
+        """Queue this packet for the client and send what we can."""
+        outbox = self._outboxes.get(sid)
+        if outbox is None:
+            outbox = self._outboxes[sid] = ClientOutbox()
+        outbox.put(stream, encoded)
+        self._flush(server, sid, outbox)
+
+    def flush(self, server) -> None:
+        """Send what we can to every client, disconnect stuck clients."""
+        now = time.time()
+        for sid, outbox in list(self._outboxes.items()):
+            self._flush(server, sid, outbox)
+
+            if outbox.pending == 0:
+                outbox.stalled_since = None  # Keeping up.
+            elif outbox.stalled_since is None:
+                outbox.stalled_since = now
+            elif now - outbox.stalled_since > DISCONNECT_SECONDS:
+                LOGGER.warning(
+                    "Disconnecting stalled client %s dropped=%d",
+                    sid,
+                    outbox.stats.dropped,
+                )
+                self.remove(sid)
+                server.disconnect(sid, namespace='/test')
+
+    def metrics(self, server) -> dict:
+        """Return the queue depth and drop counts of every client."""
+        return {
+            sid: {
+                'depth': _queue_depth(server, sid),
+                'pending': outbox.pending,
+                'pending_bytes': outbox.pending_bytes,
+                **outbox.stats.as_dict(),
+            }
+            for sid, outbox in self._outboxes.items()
+        }
+
+    def _flush(self, server, sid: str, outbox: ClientOutbox) -> int:
+        """Send packets until the client has MAX_IN_FLIGHT queued.
+
+        Return
+        ------
+        int
+            The depth of the client's engine.io queue.
+        """
+        depth = _queue_depth(server, sid)
+        outbox.stats.max_depth = max(outbox.stats.max_depth, depth)
+
+        while depth < MAX_IN_FLIGHT:
+            encoded = outbox.pop()
+            if encoded is None:
+                break
+            self._send(server, sid, encoded)
+            outbox.stats.sent += 1
+            outbox.stalled_since = None  # Not stuck, only slow.
+            depth += 1
+
+        return depth
+
+
+def _queue_depth(server, sid: str) -> int:
+    """Return how many packets are waiting in the client's engine.io queue.
+
+    Parameters
+    ----------
+    server : socketio.Server
+        The socketio server.
+    sid : str
+        The client's session id.
+    """
+    socket = server.eio.sockets.get(sid)
+    if socket is None:
+        return 0  # Gone or not fully connected.
+    return socket.queue.qsize()
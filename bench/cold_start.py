@@ -0,0 +1,138 @@
+"""Cold start benchmark.
+
+Measure how long webmon takes from launch until:
+
+    import - "import webmon" finished, in a separate process.
+    serve  - The /viewer page loaded.
+    assets - The viewer.js bundle it links to loaded, compressed.
+    frame  - A socketio client got its first set_layer_data frame.
+
+Run it with NAPARI_MON_CLIENT set, like napari sets it, so webmon has a
+napari to connect to. Without napari there's no frame, so we report only
+the other stages:
+
+    python bench/cold_start.py --runs 5
+"""
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import click
+import requests
+import socketio
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Give up waiting on a stage after this many seconds.
+TIMEOUT_SECONDS = 30
+
+POLL_SECONDS = 0.01
+
+
+def _time_import() -> float:
+    """Return how long "import webmon" takes in a new process."""
+    start = time.perf_counter()
+    command = [sys.executable, "-c", "import webmon"]
+    subprocess.run(command, cwd=ROOT, check=True)
+    return time.perf_counter() - start
+
+
+def _wait_for_page(url: str, start: float) -> Optional[str]:
+    """Return the page once the server serves it, None on timeout."""
+    while time.perf_counter() - start < TIMEOUT_SECONDS:
+        try:
+            response = requests.get(url)
+            if response.ok:
+                return response.text
+        except requests.exceptions.ConnectionError:
+            pass  # Not serving yet.
+        time.sleep(POLL_SECONDS)
+    return None
+
+
+def _wait_for_frame(url: str, start: float) -> Optional[float]:
+    """Return when the first frame arrived, None on timeout."""
+    client = socketio.Client()
+    frames = []
+    client.on(
+        'set_layer_data',
+        lambda data: frames.append(time.perf_counter()),
+        namespace='/test',
+    )
+    client.connect(url, namespaces=['/test'])
+    try:
+        while not frames and time.perf_counter() - start < TIMEOUT_SECONDS:
+            time.sleep(POLL_SECONDS)
+    finally:
+        client.disconnect()
+    return frames[0] if frames else None
+
+
+def run_once(port: int) -> Dict[str, Optional[float]]:
+    """Start webmon, time each stage, stop webmon."""
+    url = f"http://localhost:{port}"
+    result = {'import': _time_import()}
+
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "webmon.py", "--port", str(port)], cwd=ROOT
+    )
+    try:
+        page = _wait_for_page(f"{url}/viewer", start)
+        result['serve'] = None if page is None else time.perf_counter() - start
+        if page is None:
+            return result
+
+        bundle = re.search(r"from '(/static/viewer\.js[^']*)'", page)
+        response = requests.get(
+            url + bundle.group(1), headers={'Accept-Encoding': 'br, gzip'}
+        )
+        result['assets'] = time.perf_counter() - start
+        result['asset_bytes'] = len(response.content)
+        result['asset_encoding'] = response.headers.get('Content-Encoding')
+
+        frame = _wait_for_frame(url, start)
+        result['frame'] = None if frame is None else frame - start
+        return result
+    finally:
+        try:
+            requests.get(f"{url}/stop")
+        except requests.exceptions.ConnectionError:
+            pass
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def _median(results: List[dict], key: str) -> Optional[float]:
+    values = [result[key] for result in results if result.get(key)]
+    return statistics.median(values) if values else None
+
+
+@click.command()
+@click.option('--runs', default=5, help="Number of cold starts to time")
+@click.option('--port', default=5099, help="Port to run webmon on")
+def main(runs: int, port: int) -> None:
+    """Time webmon's cold start, print the median of each stage."""
+    if 'NAPARI_MON_CLIENT' not in os.environ:
+        print("NAPARI_MON_CLIENT not set, no napari so no frame.")
+
+    results = [run_once(port) for _ in range(runs)]
+    summary = {
+        f"{stage}_seconds": _median(results, stage)
+        for stage in ['import', 'serve', 'assets', 'frame']
+    }
+    summary['asset_bytes'] = results[-1].get('asset_bytes')
+    summary['asset_encoding'] = results[-1].get('asset_encoding')
+    print(json.dumps({'runs': results, 'median': summary}, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,8 +11,13 @@ from typing import Optional
 
 from flask_socketio import SocketIO
 
+from broadcast import Broadcaster
+from capture import Capture
+from commands import ACK_KEY, CommandTracker
+from hitches import HitchDetector, HitchLog
 from lib.numpy_json import NumpyJSON
-from napari_client import NapariClient
+from napari_client import FEATURE_COMMAND_ACK, NapariClient
+from streams import StreamRegistry
 
 LOGGER = logging.getLogger("webmon")
 
@@ -20,44 +25,13 @@ LOGGER = logging.getLogger("webmon")
 POLL_INTERVAL_MS = 16.7
 POLL_INTERVAL_SECONDS = POLL_INTERVAL_MS / 1000
 
+# Log the full layer data every frame, which means encoding it an extra
+# time. Only useful for debugging.
+LOG_LAYER_DATA = False
 
-class ChartMessages:
-    def __init__(self):
-        self.keys = ['frame_time', 'load_chunk']
-        self._messages = {key: [] for key in self.keys}
-        self._last_time = None
-
-    def clear(self) -> None:
-        for values in self._messages.values():
-            values.clear()
-
-    def add_chart_message(self, message) -> bool:
-        """If this is a chart message add it and return True.
-
-        A chart mesage is like:
-
-        {
-            "frame_time": {
-                "delta_ms" 16.7
-            }
-        }
-
-        """
-        for key in self.keys:
-            if key in message:
-                one_message = message[key]
-                self._messages[key].append(one_message)
-                return True
-
-        return False  # Not a chart message.
-
-    @property
-    def messages(self):
-        return self._messages
-
-    def log_counts(self) -> None:
-        for key, values in self.messages.items():
-            LOGGER.info("Key %s: %d values", key, len(values))
+# When publishing to a message queue the web clients cannot ask us for
+# chart data, so we push it to them at the rate loader.js would ask.
+CHART_INTERVAL_SECONDS = 0.1
 
 
 class NapariBridge:
@@ -69,20 +43,76 @@ class NapariBridge:
         The main SocketIO instance.
     client : NapariClient
         The client that's talking to napari.
+    publish : bool
+        If True we are the ingest process publishing to a message queue
+        that socketio worker processes are reading from.
+    room : Optional[str]
+        Emit to this socketio room, or to the whole namespace if None.
+    hitch_log : Optional[HitchLog]
+        If given we write every hitch we detect to this log.
+    capture : Optional[Capture]
+        If given we record napari's streams to this capture.
 
     Attributes
     ----------
     _commands : Queue
         set_command() puts command into this queue.
+    _command_tracker : CommandTracker
+        Coalesces commands and times their round trip through napari.
+    _hitches : HitchDetector
+        Finds frame hitches in the frame_time and load_chunk streams.
+
+    Notes
+    -----
+    The Broadcaster encodes each payload once no matter how many web
+    clients receive it. When publishing it publishes the encoded packet,
+    so it's encoded once here instead of once per worker.
     """
 
-    def __init__(self, socketio: SocketIO, client: NapariClient):
+    def __init__(
+        self,
+        socketio: SocketIO,
+        client: Optional[NapariClient],
+        publish: bool = False,
+        room: Optional[str] = None,
+        hitch_log: Optional[HitchLog] = None,
+        capture: Optional[Capture] = None,
+    ):
         self._socketio = socketio
         self._client = client
+        self._publish = publish
+        self._room = room
+        self._capture = capture
+        self._running = False
+        self._broadcaster = Broadcaster(socketio, '/test', publish)
         self._commands = Queue()
+        self._command_tracker = CommandTracker()
         self._frame_number = 0
-        self._chart_messages = ChartMessages()
+        self._message_number = 0
+        self._chart_number = 0
+        self._state_number = 0
+        self._streams = StreamRegistry()
+        self._streams.tap("frame_time")
+        self._streams.tap("load_chunk")
+        self._hitches = HitchDetector(hitch_log, room)
+        self._hitch_number = 0
         self._last_emit = None
+        self._last_chart_push = time.time()
+        self._last_poll_data = None
+
+    def set_client(self, client: Optional[NapariClient]) -> None:
+        """Talk to this client, or to no client if None.
+
+        Parameters
+        ----------
+        client : Optional[NapariClient]
+            The new client, after we reconnected to napari.
+        """
+        self._client = client
+
+    def stop(self) -> None:
+        """Stop the background task."""
+        self._running = False
 
     def send_command(self, command: dict) -> None:
         """Set this command to napari.
@@ -97,6 +127,46 @@ class NapariBridge:
         """
         self._commands.put(command)
 
+    def record_browser_rtt(self, rtt_ms: float) -> None:
+        """A web client measured the round trip of one of its commands.
+
+        Parameters
+        ----------
+        rtt_ms : float
+            The round trip in milliseconds.
+        """
+        self._command_tracker.record_browser_rtt(rtt_ms)
+
+    def command_stats(self) -> dict:
+        """Return command latency histograms and counts."""
+        return self._command_tracker.as_dict()
+
+    def remove_client(self, sid: str) -> None:
+        """Forget this web client, it disconnected.
+
+        Parameters
+        ----------
+        sid : str
+            The client's session id.
+        """
+        self._broadcaster.remove_client(sid)
+
+    def client_metrics(self) -> dict:
+        """Return send queue metrics for every web client."""
+        return self._broadcaster.client_metrics()
+
+    def memory(self) -> dict:
+        """Return the sizes of the data we are holding."""
+        client = self._client
+        return {
+            'commands': self._commands.qsize(),
+            'pending_acks': self._command_tracker.num_pending,
+            'streams': self._streams.memory(),
+            'frame_cache_bytes': self._broadcaster.cache_bytes(),
+            'clients': self._broadcaster.client_metrics(),
+            'napari': None if client is None else client.memory(),
+        }
+
     def start_background_task(self) -> Thread:
         """Start our background task.
 
@@ -105,6 +175,7 @@ class NapariBridge:
         Thread
             A Thread-compatible object.
         """
+        self._running = True
         return self._socketio.start_background_task(
             target=self._background_task
         )
@@ -113,40 +184,85 @@ class NapariBridge:
         """Background task that shuttles data to/from napari and the WebUI."""
         LOGGER.info("Webmon: Start background task thread_id=%d", get_ident())
 
-        while True:
+        while self._running:
+            self._broadcaster.tick(self._frame_number)
             self._frame_number += 1
 
             # LOGGER.info("Sleeping %f", poll_seconds)
             self._socketio.sleep(POLL_INTERVAL_SECONDS)
 
-            if self._client is None:
+            # The SessionPool calls set_client() from its own task, which
+            # could run whenever we sleep, so use one client for the tick.
+            client = self._client
+            if client is None:
                 continue  # Can't do much without a client.
 
-            self._process_messages_from_napari()
-            self._process_poll_data()
-            self._send_commands_to_napari()
+            self._process_messages_from_napari(client)
+            self._detect_hitches()
+            self._process_poll_data(client)
+            self._emit_stream_states()
+            self._send_commands_to_napari(client)
 
-    def _process_poll_data(self) -> None:
+            if self._publish:
+                self._push_chart_data()
+
+    def _process_poll_data(self, client: NapariClient) -> None:
         """Process the "poll" message from napari.
 
         Napari sends a "poll" message once per frame. It's meant to contain
         data that potentially changes every frame, like information related
         to the current camera position which might be moving.
+
+        Parameters
+        ----------
+        client : NapariClient
+            The client for this tick.
         """
-        poll_data = self._client.get_napari_data("poll")
-        if poll_data is None:
-            return  # No poll data
+        poll_data = client.get_napari_data("poll")
+        if poll_data is None or poll_data is self._last_poll_data:
+            return  # No new poll data.
+        self._last_poll_data = poll_data
 
         # Extract the layer data and send to viewer.
         layer_data = self._get_layer_data(poll_data)
 
+        if layer_data and self._capture is not None:
+            napari_time = poll_data.get('time', time.time())
+            self._capture.write_layer_data(self._room, layer_data, napari_time)
+
         if layer_data:
-            LOGGER.info("layer_data = %s", NumpyJSON.pretty(layer_data))
+            stamps = self._stamp(client, poll_data)
+            layer_data = {**layer_data, 'stamps': stamps}
 
-            self._socketio.emit(
-                'set_layer_data', layer_data, namespace='/test'
+            if LOG_LAYER_DATA:
+                LOGGER.info("layer_data = %s", NumpyJSON.pretty(layer_data))
+
+            self._broadcaster.emit(
+                'set_layer_data', layer_data, self._frame_number, self._room
             )
 
+    def _stamp(self, client: NapariClient, poll_data: dict) -> dict:
+        """Return when this poll data passed each hop, on our clock.
+
+        The web client adds its own receive time, and uses these to show
+        how stale the displayed frame is.
+
+        Parameters
+        ----------
+        client : NapariClient
+            The client the poll data came from.
+        poll_data : dict
+            The poll data, with napari's time if napari sent it.
+        """
+        stamps = {
+            'webmon_recv': client.get_received_time("poll"),
+            'webmon_send': time.time(),
+        }
+        napari_time = poll_data.get('time')
+        if napari_time is not None and client.clock.synced:
+            stamps['napari'] = client.clock.to_local(napari_time)
+        return stamps
+
     def _get_layer_data(self, poll_data) -> Optional[dict]:
         """Return the latest layer data from the poll_data
 
@@ -166,7 +282,7 @@ class NapariBridge:
         Optional[dict]
             The layer data data or None if there was none.
         """
-        layers = poll_data['layers']
+        layers = poll_data.get('layers') or {}
         for layer_data in layers.values():
             # Right now we just return the first octree layer's data, someday
             # maybe the viewer can display multiple layers.
@@ -174,47 +290,121 @@ class NapariBridge:
 
         return None  # No layers?
 
-    def _send_commands_to_napari(self) -> None:
-        """Send all pending commands to napari."""
+    def _send_commands_to_napari(self, client: NapariClient) -> None:
+        """Send all pending commands to napari.
+
+        If several commands of the same type arrived this tick, we only
+        send the latest one.
+
+        Parameters
+        ----------
+        client : NapariClient
+            Send the commands with this client.
+        """
+        commands = []
         while True:
             try:
-                command = self._commands.get_nowait()
+                commands.append(self._commands.get_nowait())
             except Empty:
-                return  # No more commands to send.
+                break  # No more commands to send.
+
+        for command in self._command_tracker.coalesce(commands):
+            self._command_tracker.on_sent(command)
+            if FEATURE_COMMAND_ACK not in client.features:
+                # Napari would take the meta for a command it doesn't know.
+                command = {
+                    key: value
+                    for key, value in command.items()
+                    if key != 'meta'
+                }
+            client.send_message(command)
 
-            if self._client is None:
-                LOGGER.warning("Cannot send command (no client): %s", command)
-            else:
-                self._client.send_message(command)
+    def _process_ack(self, ack: dict) -> None:
+        """Napari acked a command, pass the ack to the web client."""
+        result = self._command_tracker.on_ack(ack)
+        if result is not None:
+            sid, client_ack = result
+            self._socketio.emit(
+                'command_ack', client_ack, namespace='/test', room=sid
+            )
 
-    def _process_messages_from_napari(self) -> None:
+    def _process_messages_from_napari(self, client: NapariClient) -> None:
         """Send napari messages to the web client"""
         num_messages = 0
 
         while True:
-            message = self._client.get_one_napari_message()
+            message = client.get_one_napari_message()
 
             if message is None:
                 return  # No more messages.
 
             num_messages += 1
 
-            # Try adding it as a chart message. We store these up and only
-            # send them when the web client asks for them. Otherwise the
-            # web client would bog down with too many messages.
-            if not self._chart_messages.add_chart_message(message):
-                # Was not a chart message so just pass it to the web client.
-                self._socketio.emit(
-                    'napari_message', message, namespace='/test'
+            if ACK_KEY in message:
+                self._process_ack(message[ACK_KEY])
+                continue
+
+            if self._capture is not None:
+                self._capture.write_message(self._room, message)
+
+            # Try adding it as a stream message. We store these up and only
+            # send them once per tick or when the web client asks for them.
+            # Otherwise the web client would bog down with too many messages.
+            if not self._streams.add_message(message):
+                # Was not a stream message so just pass it to the web client.
+                self._message_number += 1
+                self._broadcaster.emit(
+                    'napari_message',
+                    message,
+                    self._message_number,
+                    self._room,
                 )
 
         LOGGER.info("Received %d messages from napari.", num_messages)
 
+    def _detect_hitches(self) -> None:
+        """Send the hitches in this tick's frame times to the web client.
+
+        The detector sees every frame_time value, not only the ones in
+        chart data, so it does not matter how often the web client asks.
+        """
+        hitches = self._hitches.process(
+            self._streams.take_tap("frame_time"),
+            self._streams.take_tap("load_chunk"),
+        )
+        for hitch in hitches:
+            self._hitch_number += 1
+            self._broadcaster.emit(
+                'hitch', hitch, self._hitch_number, self._room
+            )
+
+    def _emit_stream_states(self) -> None:
+        """Send the state streams that changed this tick.
+
+        Each state gets its own number, the Broadcaster caches encoded
+        packets by stream and number.
+        """
+        for state in self._streams.take_states():
+            self._state_number += 1
+            self._broadcaster.emit(
+                'stream_state', state, self._state_number, self._room
+            )
+
+    def _push_chart_data(self) -> None:
+        """Emit chart data if CHART_INTERVAL_SECONDS has elapsed."""
+        now = time.time()
+        if now - self._last_chart_push >= CHART_INTERVAL_SECONDS:
+            self._last_chart_push = now
+            self.emit_chart_data()
+
     def emit_chart_data(self):
-        messages = self._chart_messages.messages
+        """Send the buffered event streams to the web client.
 
-        for key, values in messages.items():
-            LOGGER.info("Sending %s: %d values", key, len(values))
+        We send binary columns, even when publishing, the workers relay
+        the encoded packet with its binary attachments as is.
+        """
+        for key, count in self._streams.counts().items():
+            LOGGER.info("Sending %s: %d values", key, count)
 
         if self._last_emit is None:
             self._last_emit = time.time()
@@ -224,6 +414,10 @@ class NapariBridge:
             LOGGER.info("last emit: %f", elapsed)
             self._last_emit = now
 
-        self._socketio.emit('chart_data', messages, namespace='/test')
-        self._chart_messages.clear()
+        messages = self._streams.take_events(binary=True)
+
+        self._chart_number += 1
+        self._broadcaster.emit(
+            'chart_data', messages, self._chart_number, self._room
+        )
 
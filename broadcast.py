@@ -0,0 +1,240 @@
+"""Broadcaster class.
+
+Emit frames to many web clients while encoding each frame only once.
+
+A plain socketio.emit() builds and encodes a new socket.io packet for every
+recipient. Instead we encode the packet once, cache it, and hand the same
+encoded packet to every recipient's ClientQueues outbox, which sends it to
+the recipient's engine.io socket when the client is keeping up.
+
+In fan-out mode the ingest process encodes the packet once and publishes
+the encoded packet, wrapped in a {RELAY_KEY: packet} dict. Each worker's
+RelayManager, see fanout.py, hands it to relay() on its own Broadcaster,
+so the workers never encode it again.
+"""
+import logging
+from typing import Dict, Optional, Tuple
+
+from flask_socketio import SocketIO
+from socketio import packet
+
+from backpressure import ClientQueues
+from lib.memory import encoded_size
+
+LOGGER = logging.getLogger("webmon")
+
+# Log the counters every this many ticks, about once a second at 60Hz.
+LOG_COUNTERS_TICKS = 60
+
+# Encodings we cache.
+ENCODING_PACKET = "packet"  # An encoded socket.io packet.
+
+# Published payloads are {RELAY_KEY: encoded packet}.
+RELAY_KEY = "webmon_packet"
+
+
+class FrameCache:
+    """Encoded frames keyed by (stream, frame_number, encoding).
+
+    We only keep the latest frame of each stream. Once a stream moves on
+    to a new frame its older encodings can never be used again.
+    """
+
+    def __init__(self):
+        self._frames: Dict[str, Tuple[int, dict]] = {}
+
+    def get(self, stream: str, frame_number: int, encoding: str):
+        """Return the cached encoding or None if we don't have it."""
+        cached = self._frames.get(stream)
+        if cached is None or cached[0] != frame_number:
+            return None
+        return cached[1].get(encoding)
+
+    def put(self, stream: str, frame_number: int, encoding: str, encoded):
+        """Cache this encoding, evicting the stream's older frames."""
+        cached = self._frames.get(stream)
+        if cached is None or cached[0] != frame_number:
+            cached = (frame_number, {})
+            self._frames[stream] = cached
+        cached[1][encoding] = encoded
+
+    @property
+    def nbytes(self) -> int:
+        """The size of all the cached encodings."""
+        return sum(
+            encoded_size(encoded)
+            for _, encodings in self._frames.values()
+            for encoded in encodings.values()
+        )
+
+
+class BroadcastCounters:
+    """Counts encodes and sends for one tick."""
+
+    def __init__(self):
+        self.encode_calls = 0
+        self.cache_hits = 0
+        self.emits = 0
+        self.fan_out = 0  # Number of sockets we sent to.
+
+    def log(self, frame_number: int) -> None:
+        LOGGER.info(
+            "Broadcast frame %d: encode_calls=%d cache_hits=%d emits=%d "
+            "fan_out=%d",
+            frame_number,
+            self.encode_calls,
+            self.cache_hits,
+            self.emits,
+            self.fan_out,
+        )
+
+
+class Broadcaster:
+    """Emit frames to web clients, encoding each frame once.
+
+    Parameters
+    ----------
+    socketio : SocketIO
+        The main SocketIO instance.
+    namespace : str
+        The SocketIO namespace such as "/test".
+    publish : bool
+        If True we are publishing to a message queue. Then we have no
+        sockets of our own, so we publish the encoded packet for the
+        workers to relay.
+
+    Attributes
+    ----------
+    counters : BroadcastCounters
+        The counters for the current tick.
+    """
+
+    def __init__(
+        self, socketio: SocketIO, namespace: str, publish: bool = False
+    ):
+        self._socketio = socketio
+        self._namespace = namespace
+        self._publish = publish
+        self._cache = FrameCache()
+        self._queues = ClientQueues(self._send)
+        self._ticks = 0
+        self.counters = BroadcastCounters()
+
+    def emit(
+        self,
+        stream: str,
+        data,
+        frame_number: int,
+        room: Optional[str] = None,
+    ) -> None:
+        """Emit this frame to every web client in the room.
+
+        Parameters
+        ----------
+        stream : str
+            The socketio event name.
+        data
+            The payload, anything NumpyJSON can encode.
+        frame_number : int
+            Together with the stream this identifies the payload.
+        room : Optional[str]
+            Emit to this room, or to the whole namespace if None.
+        """
+        self.counters.emits += 1
+        encoded = self._encode(stream, data, frame_number, ENCODING_PACKET)
+
+        if self._publish:
+            self._socketio.emit(
+                stream,
+                {RELAY_KEY: encoded},
+                namespace=self._namespace,
+                room=room,
+            )
+        else:
+            self.relay(stream, encoded, room)
+
+    def relay(self, stream: str, encoded, room: Optional[str] = None):
+        """Send an already encoded packet to every web client in the room.
+
+        Parameters
+        ----------
+        stream : str
+            The socketio event name, which picks the backpressure policy.
+        encoded : str or list
+            The encoded socket.io packet.
+        room : Optional[str]
+            Send to this room, or to the whole namespace if None.
+        """
+        server = self._socketio.server
+        if server is None:
+            return  # Not serving yet.
+
+        # get_participants() raises KeyError until someone joins the
+        # namespace, and for a room whose last client left.
+        manager = server.manager
+        if room not in manager.rooms.get(self._namespace, {}):
+            return
+
+        for sid in manager.get_participants(self._namespace, room):
+            self._queues.put(server, sid, stream, encoded)
+            self.counters.fan_out += 1
+
+    def remove_client(self, sid: str) -> None:
+        """Forget this client, it disconnected."""
+        self._queues.remove(sid)
+
+    def client_metrics(self) -> dict:
+        """Return the queue depth and drop counts of every client."""
+        server = self._socketio.server
+        if server is None or self._publish:
+            return {}
+        return self._queues.metrics(server)
+
+    def cache_bytes(self) -> int:
+        """Return the size of the encoded frames we are caching."""
+        return self._cache.nbytes
+
+    def tick(self, frame_number: int) -> None:
+        """Start a new tick, logging the counters now and then.
+
+        Also send packets the client queues were holding back.
+        """
+        server = self._socketio.server
+        if server is not None and not self._publish:
+            self._queues.flush(server)
+
+        self._ticks += 1
+        if self._ticks % LOG_COUNTERS_TICKS == 0:
+            self.counters.log(frame_number)
+        self.counters = BroadcastCounters()
+
+    def _encode(self, stream: str, data, frame_number: int, encoding: str):
+        """Return the cached encoding, encoding it if not cached."""
+        encoded = self._cache.get(stream, frame_number, encoding)
+        if encoded is not None:
+            self.counters.cache_hits += 1
+            return encoded
+
+        self.counters.encode_calls += 1
+        pkt = packet.Packet(
+            packet.EVENT, data=[stream, data], namespace=self._namespace
+        )
+        encoded = pkt.encode()
+
+        self._cache.put(stream, frame_number, encoding, encoded)
+        return encoded
+
+    @staticmethod
+    def _send(server, sid: str, encoded) -> None:
+        """Send an encoded packet to one socket.
+
+        A packet with binary attachments encodes to a list, the first
+        element is the packet itself and the rest are the attachments.
+        """
+        if isinstance(encoded, list):
+            binary = False
+            for part in encoded:
+                server.eio.send(sid, part, binary=binary)
+                binary = True
+        else:
+            server.eio.send(sid, encoded, binary=False)
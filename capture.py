@@ -0,0 +1,97 @@
+"""Capture class.
+
+Record the streams napari sends us to a file, for offline analysis with
+"python webmon.py analyze", see analyze.py.
+
+The capture is JSON lines, one record per line:
+
+    {"session": "default", "stream": "frame_time", "data": {...}}
+    {"session": "default", "stream": "load_chunk", "data": {...}}
+    {"session": "default", "stream": "tile_state", "data": {...}}
+
+The frame_time and load_chunk data is the message napari sent. The
+tile_state data is the "seen" tiles from the poll data, with the
+level_index and time added.
+"""
+import logging
+from typing import Optional
+
+from lib.numpy_json import NumpyJSON
+
+LOGGER = logging.getLogger("webmon")
+
+# The streams we record.
+CAPTURE_STREAMS = ["frame_time", "load_chunk", "tile_state"]
+
+
+class Capture:
+    """Append stream records to a JSON lines file.
+
+    Parameters
+    ----------
+    path : str
+        Append to the file at this path.
+    """
+
+    def __init__(self, path: str):
+        # Big buffer, a capture can be written 60 times a second for hours.
+        self._file = open(path, "a", buffering=1 << 20)
+        LOGGER.info("Capturing streams to %s", path)
+
+    def write(self, session: Optional[str], stream: str, data: dict) -> None:
+        """Append one record.
+
+        Parameters
+        ----------
+        session : Optional[str]
+            The session the record is from.
+        stream : str
+            One of CAPTURE_STREAMS.
+        data : dict
+            The record's data.
+        """
+        record = {'session': session, 'stream': stream, 'data': data}
+        self._file.write(NumpyJSON.dumps(record) + "\n")
+
+    def write_message(self, session: Optional[str], message: dict) -> None:
+        """Append the message if it's one of the streams we record.
+
+        Parameters
+        ----------
+        session : Optional[str]
+            The session the message is from.
+        message : dict
+            A message from napari like {"frame_time": {"delta_ms": 16.7}}.
+        """
+        for stream, data in message.items():
+            if stream in CAPTURE_STREAMS and isinstance(data, dict):
+                self.write(session, stream, data)
+
+    def write_layer_data(
+        self, session: Optional[str], layer_data: dict, time: float
+    ) -> None:
+        """Append the seen tiles of this layer data.
+
+        Parameters
+        ----------
+        session : Optional[str]
+            The session the layer data is from.
+        layer_data : dict
+            The layer data with its tile_state and tile_config.
+        time : float
+            Napari's time for the poll data, or our time if it sent none.
+        """
+        tile_state = layer_data.get('tile_state') or {}
+        tile_config = layer_data.get('tile_config') or {}
+        self.write(
+            session,
+            "tile_state",
+            {
+                'time': time,
+                'level_index': tile_config.get('level_index', 0),
+                'seen': tile_state.get('seen', []),
+            },
+        )
+
+    def close(self) -> None:
+        self._file.close()
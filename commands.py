@@ -0,0 +1,181 @@
+"""CommandTracker class.
+
+Sequence, coalesce and time the commands the web client sends to napari.
+
+Each command carries a "meta" dict. The web client fills in its own seq,
+the command type and browser_time. Webmon adds the sid of the web client,
+webmon_recv when it received the command, and its own seq and
+webmon_sent when it passes the command to napari:
+
+    {
+        "show_grid": true,
+        "meta": {
+            "type": "viewer_controls",
+            "browser_seq": 12,
+            "browser_time": 1612345678.123,
+            "sid": "a1b2c3",
+            "webmon_recv": 1612345678.125,
+            "seq": 345,
+            "webmon_sent": 1612345678.140
+        }
+    }
+
+Napari acks each command it handles with a message like:
+
+    {"command_ack": {"seq": 345, "napari_time": 1612345678.150}}
+
+Only napari builds which announced the "command_ack" feature get the meta,
+see napari_client.py. Older builds get the command without it, never ack,
+and their pending commands expire after ACK_TIMEOUT_SECONDS.
+
+We pass the ack back to the web client, which measures the full round
+trip on its own clock and reports it back to us.
+"""
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from lib.histogram import Histogram
+
+LOGGER = logging.getLogger("webmon")
+
+ACK_KEY = "command_ack"
+
+# Forget commands napari has not acked after this long. Older napari
+# builds never send acks.
+ACK_TIMEOUT_SECONDS = 10
+
+# The hops we time, all in milliseconds.
+HOPS = [
+    "webmon_queue_ms",  # Received from the web client to sent to napari.
+    "napari_rtt_ms",  # Sent to napari until napari's ack arrived.
+    "browser_rtt_ms",  # The whole round trip measured by the web client.
+]
+
+
+def _command_type(command: dict) -> str:
+    """Return the command's type, used to coalesce commands.
+
+    Commands without a type are typed by the names of their fields.
+    """
+    command_type = command.get('meta', {}).get('type')
+    if command_type is not None:
+        return command_type
+    return ",".join(sorted(key for key in command if key != 'meta'))
+
+
+class CommandTracker:
+    """Sequence numbers, coalescing and latency histograms for commands.
+
+    Attributes
+    ----------
+    histograms : Dict[str, Histogram]
+        A latency histogram for each of the HOPS.
+    coalesced : int
+        How many commands we dropped because a newer one replaced them.
+    _pending : Dict[int, dict]
+        The commands sent to napari which it has not acked yet, by seq.
+    """
+
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {
+            hop: Histogram(hop) for hop in HOPS
+        }
+        self.coalesced = 0
+        self._seq = 0
+        self._pending: Dict[int, dict] = {}
+
+    def coalesce(self, commands: List[dict]) -> List[dict]:
+        """Return the commands with superseded ones removed.
+
+        A later command of the same type replaces an earlier one. The
+        result keeps the order in which each type first appeared.
+
+        Parameters
+        ----------
+        commands : List[dict]
+            The commands received during this tick, oldest first.
+        """
+        latest: Dict[str, dict] = OrderedDict()
+        for command in commands:
+            latest[_command_type(command)] = command
+
+        self.coalesced += len(commands) - len(latest)
+        return list(latest.values())
+
+    def on_sent(self, command: dict) -> None:
+        """Stamp the command with our seq just before sending it."""
+        now = time.time()
+        self._seq += 1
+
+        meta = command.setdefault('meta', {})
+        meta['seq'] = self._seq
+        meta['webmon_sent'] = now
+
+        if 'webmon_recv' in meta:
+            queue_ms = (now - meta['webmon_recv']) * 1000
+            self.histograms["webmon_queue_ms"].record(queue_ms)
+
+        self._pending[self._seq] = meta
+        self._expire(now)
+
+    def on_ack(self, ack: dict) -> Optional[Tuple[str, dict]]:
+        """Napari acked a command, return the ack for the web client.
+
+        Parameters
+        ----------
+        ack : dict
+            The body of the "command_ack" message from napari.
+
+        Return
+        ------
+        Optional[Tuple[str, dict]]
+            The sid of the web client and the ack to send it, or None if
+            we don't know who sent the command.
+        """
+        meta = self._pending.pop(ack.get('seq'), None)
+        if meta is None:
+            return None
+
+        napari_rtt_ms = (time.time() - meta['webmon_sent']) * 1000
+        self.histograms["napari_rtt_ms"].record(napari_rtt_ms)
+
+        sid = meta.get('sid')
+        if sid is None:
+            return None
+
+        return sid, {
+            **meta,
+            'napari_time': ack.get('napari_time'),
+            'napari_rtt_ms': napari_rtt_ms,
+        }
+
+    @property
+    def num_pending(self) -> int:
+        """The number of commands napari has not acked yet."""
+        return len(self._pending)
+
+    def record_browser_rtt(self, rtt_ms: float) -> None:
+        """The web client measured a whole round trip."""
+        self.histograms["browser_rtt_ms"].record(rtt_ms)
+
+    def as_dict(self) -> dict:
+        """Return the latency histograms and counts."""
+        return {
+            'sent': self._seq,
+            'pending': self.num_pending,
+            'coalesced': self.coalesced,
+            **{
+                name: histogram.as_dict()
+                for name, histogram in self.histograms.items()
+            },
+        }
+
+    def _expire(self, now: float) -> None:
+        """Forget pending commands which napari is never going to ack."""
+        cutoff = now - ACK_TIMEOUT_SECONDS
+        for seq, meta in list(self._pending.items()):
+            if meta['webmon_sent'] >= cutoff:
+                break  # The rest are newer.
+            del self._pending[seq]
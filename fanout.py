@@ -0,0 +1,263 @@
+"""Fan-out mode.
+
+Run one ingest process and N socketio worker processes:
+
+    ingest: owns the NapariClient and publishes frames once to a message
+            queue using Flask-SocketIO's message_queue support.
+    worker: serves web clients, our RelayManager relays everything
+            published to the message queue to the worker's own clients.
+
+The ingest process publishes each frame as an encoded socket.io packet,
+see broadcast.py. The worker's RelayManager hands the packet to the
+worker's Broadcaster, which queues it for each client as is. So a frame is
+encoded once in total, not once per worker or once per client, and each
+client still gets its own backpressure.
+
+Published frames only flow one way, from ingest to the workers. Commands
+from the web clients flow back to the ingest process over a Unix socket.
+
+The message queue is any URL Flask-SocketIO accepts, for example a local
+Redis or Redis-compatible server at "redis://localhost:6379/0".
+"""
+import logging
+import os
+from multiprocessing.connection import Client, Listener
+from threading import Thread
+from typing import Optional
+
+import socketio as socketio_lib
+from flask_socketio import SocketIO
+
+from bridge import POLL_INTERVAL_SECONDS, NapariBridge
+from broadcast import RELAY_KEY, Broadcaster
+from capture import Capture
+from hitches import HitchLog
+from lib.numpy_json import NumpyJSON
+from napari_client import NapariClient
+
+LOGGER = logging.getLogger("webmon")
+
+# Default path of the Unix socket commands are sent over.
+COMMAND_SOCKET = "/tmp/webmon-commands.sock"
+
+# How often the ingest process checks if the NapariClient has exited.
+INGEST_CHECK_SECONDS = 1
+
+# The channel Flask-SocketIO publishes on by default.
+CHANNEL = "flask-socketio"
+
+
+class RelayMixin:
+    """Relay the packets the ingest process published to our Broadcaster.
+
+    Mixed into python-socketio's RedisManager or KombuManager. Anything
+    else published to the channel is emitted as usual.
+
+    Attributes
+    ----------
+    broadcaster : Optional[Broadcaster]
+        Queues the relayed packets for our web clients.
+    """
+
+    broadcaster: Optional[Broadcaster] = None
+
+    def _handle_emit(self, message: dict) -> None:
+        data = message.get('data')
+        if (
+            self.broadcaster is None
+            or not isinstance(data, dict)
+            or RELAY_KEY not in data
+        ):
+            super()._handle_emit(message)
+            return
+
+        self.broadcaster.relay(
+            message['event'], data[RELAY_KEY], message.get('room')
+        )
+
+
+def create_relay_manager(message_queue: str, broadcaster: Broadcaster):
+    """Return a client manager which relays packets to the broadcaster.
+
+    Pass it to init_app() as the client_manager instead of passing the
+    message_queue, Flask-SocketIO would create a plain manager for that.
+
+    Parameters
+    ----------
+    message_queue : str
+        Receive from the message queue at this URL.
+    broadcaster : Broadcaster
+        Relay the published packets to this broadcaster.
+    """
+    if message_queue.startswith(("redis://", "rediss://")):
+        base = socketio_lib.RedisManager
+    else:
+        base = socketio_lib.KombuManager
+
+    manager_class = type("RelayManager", (RelayMixin, base), {})
+    manager = manager_class(message_queue, channel=CHANNEL)
+    manager.broadcaster = broadcaster
+    return manager
+
+
+class CommandListener(Thread):
+    """Receive commands from the workers, runs in the ingest process.
+
+    Parameters
+    ----------
+    bridge : NapariBridge
+        We pass the commands to this bridge.
+    path : str
+        Listen on the Unix socket at this path.
+    """
+
+    def __init__(self, bridge: NapariBridge, path: str):
+        super().__init__(daemon=True)
+        self._bridge = bridge
+
+        # Remove a stale socket from an earlier run.
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        self._listener = Listener(path, family='AF_UNIX')
+        LOGGER.info("Listening for commands on %s", path)
+
+    def run(self) -> None:
+        """Accept connections from workers, one thread per worker."""
+        while True:
+            conn = self._listener.accept()
+            Thread(target=self._receive, args=(conn,), daemon=True).start()
+
+    def _receive(self, conn) -> None:
+        """Receive commands from one worker until it disconnects."""
+        try:
+            while True:
+                self._bridge.send_command(conn.recv())
+        except EOFError:
+            LOGGER.info("Worker disconnected from command socket.")
+        finally:
+            conn.close()
+
+
+class WorkerBridge:
+    """Stands in for the SessionPool inside a worker process.
+
+    The worker has no NapariClient. Napari data arrives through the message
+    queue, our RelayManager hands it to our Broadcaster which sends it to
+    the web clients. We forward commands to the ingest process.
+
+    Parameters
+    ----------
+    socketio : SocketIO
+        The worker's SocketIO instance.
+    path : str
+        The Unix socket the ingest process is listening on.
+    """
+
+    def __init__(self, socketio: SocketIO, path: str):
+        self._socketio = socketio
+        self._path = path
+        self._conn = None
+        self.broadcaster = Broadcaster(socketio, '/test')
+
+    def send_command(self, command: dict) -> None:
+        """Forward this command to the ingest process.
+
+        Parameters
+        ----------
+        command : dict
+            The command to send to napari.
+        """
+        try:
+            if self._conn is None:
+                self._conn = Client(self._path, family='AF_UNIX')
+            self._conn.send(command)
+        except (OSError, EOFError):
+            LOGGER.error("Cannot forward command to ingest: %s", command)
+            self._conn = None  # Reconnect next time.
+
+    def get_bridge(self, session_id: str) -> "WorkerBridge":
+        """Fan-out mode has a single session, so every client gets us."""
+        return self
+
+    def list(self) -> list:
+        """The ingest process knows the session, we don't."""
+        return []
+
+    def record_browser_rtt(self, rtt_ms: float) -> None:
+        """The ingest process times commands, we drop the browser's time."""
+
+    def command_stats(self) -> dict:
+        """The ingest process times commands, so we have no stats."""
+        return {}
+
+    def remove_client(self, sid: str, session_id: str) -> None:
+        """Forget the client's send queue."""
+        self.broadcaster.remove_client(sid)
+
+    def client_metrics(self) -> dict:
+        """Return send queue metrics for every web client."""
+        return self.broadcaster.client_metrics()
+
+    def memory(self) -> dict:
+        """The ingest process holds the data, we only have our sockets."""
+        return {'clients': self.broadcaster.client_metrics()}
+
+    def start_background_task(self):
+        """Start the task which flushes the client send queues."""
+        return self._socketio.start_background_task(
+            target=self._background_task
+        )
+
+    def _background_task(self) -> None:
+        """Send the packets the client queues were holding back."""
+        tick = 0
+        while True:
+            self.broadcaster.tick(tick)
+            tick += 1
+            self._socketio.sleep(POLL_INTERVAL_SECONDS)
+
+    def emit_chart_data(self) -> None:
+        """The ingest process pushes chart data on its own."""
+
+
+def run_ingest(
+    client: NapariClient,
+    message_queue: str,
+    command_socket: str,
+    hitch_log: Optional[HitchLog] = None,
+    capture: Optional[Capture] = None,
+) -> None:
+    """Run the ingest process until the NapariClient exits.
+
+    Parameters
+    ----------
+    client : NapariClient
+        The client that's talking to napari.
+    message_queue : str
+        Publish to this message queue.
+    command_socket : str
+        Receive commands from the workers on this Unix socket.
+    hitch_log : Optional[HitchLog]
+        If given we write every hitch we detect to this log.
+    capture : Optional[Capture]
+        If given we record napari's streams to this capture.
+    """
+    # A write-only SocketIO, it can emit but does not serve anything. We
+    # don't monkey patch here, the NapariClient has to stay a real thread,
+    # so the Redis client needs real threads for the background task too.
+    socketio = SocketIO(
+        message_queue=message_queue, json=NumpyJSON, async_mode="threading"
+    )
+
+    bridge = NapariBridge(
+        socketio, client, publish=True, hitch_log=hitch_log, capture=capture
+    )
+    CommandListener(bridge, command_socket).start()
+    bridge.start_background_task()
+
+    LOGGER.info("Webmon: publishing to %s", message_queue)
+    while client.is_alive():
+        socketio.sleep(INGEST_CHECK_SECONDS)
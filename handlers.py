@@ -5,13 +5,16 @@ but soon we will have one per page?
 """
 import json
 import logging
+import math
 import os
+import time
 from threading import Lock
+from typing import Dict
 
-from flask import session
-from flask_socketio import Namespace, emit
+from flask import request, session
+from flask_socketio import Namespace, emit, join_room
 
-from bridge import NapariBridge
+from sessions import DEFAULT_SESSION, SessionPool
 
 LOGGER = logging.getLogger("webmon")
 
@@ -21,8 +24,9 @@ class WebmonHandlers(Namespace):
 
     Parameters
     ----------
-    bridge : NapariBridge
-        This communicates with napari through the NapariClient.
+    sessions : SessionPool
+        The napari sessions, each has a NapariBridge which communicates
+        with napari through its NapariClient.
     namespace : str
         The SocketIO namespace such as "/test".
 
@@ -33,13 +37,21 @@ class WebmonHandlers(Namespace):
     thread : Thread
         The Thread-compatible object returned from
         socketio.start_background_task().
+    _client_sessions : Dict[str, str]
+        The session id of each web client by sid.
     """
 
-    def __init__(self, bridge: NapariBridge, namespace: str):
+    def __init__(self, sessions: SessionPool, namespace: str):
         super().__init__(namespace)
-        self._bridge = bridge
+        self._sessions = sessions
         self.lock = Lock()
         self.thread = None
+        self._client_sessions: Dict[str, str] = {}
+
+    def _get_bridge(self):
+        """Return the bridge for this web client's session, if any."""
+        session_id = self._client_sessions.get(request.sid, DEFAULT_SESSION)
+        return self._sessions.get_bridge(session_id)
 
     def on_connection_test(self, message):
         """The webapp emits this when a new connection is created."""
@@ -57,21 +69,72 @@ class WebmonHandlers(Namespace):
         emit('input_data_response', json.dumps(data))
 
     def on_send_command(self, message):
-        """Web app emits this to send a command."""
+        """Web app emits this to send a command.
+
+        We stamp the command so napari's ack can find its way back to this
+        web client, and so we can time it.
+        """
         LOGGER.info("on_send_command: %s", json.dumps(message))
-        self._bridge.send_command(message)
+        meta = message.setdefault('meta', {})
+        meta['sid'] = request.sid
+        meta['webmon_recv'] = time.time()
+
+        bridge = self._get_bridge()
+        if bridge is None:
+            LOGGER.warning("Cannot send command (no session): %s", message)
+        else:
+            bridge.send_command(message)
+
+    def on_clock_sync(self, message):
+        """Web app emits this to sync its clock with ours.
+
+        The return value is the socketio ack, the web app adds its own
+        receive time and estimates the offset like NTP does.
+        """
+        received = time.time()
+        return {'t0': message['t0'], 't1': received, 't2': time.time()}
+
+    def on_command_rtt(self, message):
+        """Web app emits this with the round trip time of a command."""
+        rtt_ms = message.get('rtt_ms') if isinstance(message, dict) else None
+        if (
+            not isinstance(rtt_ms, (int, float))
+            or isinstance(rtt_ms, bool)
+            or not math.isfinite(rtt_ms)
+            or rtt_ms < 0
+        ):
+            LOGGER.warning("Bad command_rtt from %s: %s", request.sid, message)
+            return
+
+        bridge = self._get_bridge()
+        if bridge is not None:
+            bridge.record_browser_rtt(rtt_ms)
 
     def on_connect(self):
-        """Create a background thread on connection.."""
-        LOGGER.info("on_connect")
+        """Join the client's session and create the background tasks.
 
-        # Lock is so that we only create one background task that
+        The web client picks a session with its "session" query parameter.
+        """
+        session_id = request.args.get('session', DEFAULT_SESSION)
+        LOGGER.info("on_connect session=%s", session_id)
+        self._client_sessions[request.sid] = session_id
+        join_room(session_id)
+
+        # Lock is so that we only create one set of background tasks that
         # is shared among for all viewers.
         with self.lock:
             if self.thread is None:
                 LOGGER.info("Webmon: Creating background task...")
-                self.thread = self._bridge.start_background_task()
+                self.thread = self._sessions.start_background_task()
+
+    def on_disconnect(self):
+        """Forget the client's send queue."""
+        LOGGER.info("on_disconnect")
+        session_id = self._client_sessions.pop(request.sid, DEFAULT_SESSION)
+        self._sessions.remove_client(request.sid, session_id)
 
     def on_get_chart_data(self, _message):
         LOGGER.info("on_get_chart_data")
-        self._bridge.emit_chart_data()
+        bridge = self._get_bridge()
+        if bridge is not None:
+            bridge.emit_chart_data()
@@ -0,0 +1,228 @@
+"""HitchDetector class.
+
+Find frames where napari stuttered, and the chunk loads that might be why.
+
+We keep a rolling baseline of the last BASELINE_FRAMES frame times. A frame
+is a hitch if it took much longer than the baseline median, measured in
+MADs (median absolute deviations) so one slow frame does not move the
+baseline much. For each hitch we look for load_chunk events which happened
+during that frame, and report how many chunks and bytes were loading.
+
+Everything is computed with numpy on each tick's batch of new values, so
+the cost per tick is a few small vector operations regardless of how many
+web clients are connected.
+"""
+import json
+import logging
+from typing import Dict, List, Optional
+
+import numpy as np
+
+LOGGER = logging.getLogger("webmon")
+
+# Number of recent frames in the baseline, about 5 seconds at 60Hz.
+BASELINE_FRAMES = 300
+
+# Need this many frames before we flag anything.
+MIN_BASELINE_FRAMES = 30
+
+# A hitch is more than MAD_THRESHOLD MADs above the median, and also more
+# than MIN_RATIO times the median, so a very steady baseline with a tiny
+# MAD does not flag tiny wobbles.
+MAD_THRESHOLD = 5.0
+MIN_RATIO = 1.5
+
+# Number of recent load_chunk events we can attribute hitches to.
+MAX_LOADS = 1024
+
+# The fields we need, napari can re-announce the streams with others.
+FRAME_FIELDS = ("time", "delta_ms")
+LOAD_FIELDS = ("time", "load_ms", "num_bytes")
+
+
+class RingBuffer:
+    """Fixed size numpy ring of the most recent rows.
+
+    Parameters
+    ----------
+    size : int
+        How many rows we keep.
+    columns : int
+        How many float64 columns each row has.
+    """
+
+    def __init__(self, size: int, columns: int):
+        self._data = np.zeros((size, columns))
+        self._next = 0
+        self._count = 0
+
+    def extend(self, rows: np.ndarray) -> None:
+        """Add rows, overwriting the oldest ones."""
+        rows = rows[-len(self._data) :]
+        size = len(self._data)
+        indices = (self._next + np.arange(len(rows))) % size
+        self._data[indices] = rows
+        self._next = (self._next + len(rows)) % size
+        self._count = min(self._count + len(rows), size)
+
+    @property
+    def values(self) -> np.ndarray:
+        """Return the rows we have, in no particular order."""
+        return self._data[: self._count]
+
+    def __len__(self) -> int:
+        return self._count
+
+
+class HitchLog:
+    """Append hitches to a JSON lines file.
+
+    Parameters
+    ----------
+    path : str
+        Append to the file at this path.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "a", buffering=1)  # Line buffered.
+        LOGGER.info("Logging hitches to %s", path)
+
+    def write(self, hitch: dict) -> None:
+        self._file.write(json.dumps(hitch) + "\n")
+
+
+class HitchDetector:
+    """Flag frame_time outliers and attribute them to load_chunk events.
+
+    Parameters
+    ----------
+    log : Optional[HitchLog]
+        If given we write every hitch to this log.
+    session_id : Optional[str]
+        The session we are detecting hitches for, for the log.
+    """
+
+    def __init__(
+        self, log: Optional[HitchLog] = None, session_id: Optional[str] = None
+    ):
+        self._log = log
+        self._session_id = session_id
+        self._frames = RingBuffer(BASELINE_FRAMES, 1)  # delta_ms
+        self._loads = RingBuffer(MAX_LOADS, 3)  # time, load_ms, num_bytes
+        self._missing = set()  # Streams we logged missing fields for.
+        self.num_hitches = 0
+
+    def process(
+        self,
+        frame_time: Dict[str, np.ndarray],
+        load_chunk: Dict[str, np.ndarray],
+    ) -> List[dict]:
+        """Process one tick's new values, return the hitches we found.
+
+        Parameters
+        ----------
+        frame_time : Dict[str, np.ndarray]
+            New frame_time columns, time and delta_ms.
+        load_chunk : Dict[str, np.ndarray]
+            New load_chunk columns, time, load_ms and num_bytes.
+        """
+        if self._has_fields("load_chunk", load_chunk, LOAD_FIELDS):
+            self._loads.extend(
+                np.column_stack([load_chunk[name] for name in LOAD_FIELDS])
+            )
+
+        if not self._has_fields("frame_time", frame_time, FRAME_FIELDS):
+            return []
+        deltas = frame_time['delta_ms']
+
+        hitches = []
+        if len(self._frames) >= MIN_BASELINE_FRAMES:
+            hitches = self._find_hitches(frame_time['time'], deltas)
+
+        # Add to the baseline after checking, so a hitch can't hide itself.
+        self._frames.extend(np.asarray(deltas, dtype=np.float64)[:, None])
+        return hitches
+
+    def _has_fields(self, stream: str, columns: dict, fields: tuple) -> bool:
+        """Return True if there are values with all the fields we need.
+
+        Parameters
+        ----------
+        stream : str
+            The name of the stream, for the log.
+        columns : dict
+            The stream's new columns, empty if there were no new values.
+        fields : tuple
+            The fields we need.
+        """
+        if not columns or len(next(iter(columns.values()))) == 0:
+            return False  # No new values.
+
+        missing = [name for name in fields if name not in columns]
+        if not missing:
+            return True
+
+        if stream not in self._missing:
+            self._missing.add(stream)
+            LOGGER.error("Can't find hitches, %s has no %s", stream, missing)
+        return False
+
+    def _find_hitches(
+        self, times: np.ndarray, deltas: np.ndarray
+    ) -> List[dict]:
+        """Return the frames which are hitches compared to the baseline."""
+        baseline = self._frames.values[:, 0]
+        median = np.median(baseline)
+        mad = np.median(np.abs(baseline - median))
+
+        threshold = max(median + MAD_THRESHOLD * mad, median * MIN_RATIO)
+        flagged = np.nonzero(deltas > threshold)[0]
+        if len(flagged) == 0:
+            return []
+
+        loads = self._loads.values
+        hitches = []
+        for index in flagged:
+            end = float(times[index])
+            start = end - float(deltas[index]) / 1000
+            hitch = {
+                'time': end,
+                'delta_ms': float(deltas[index]),
+                'median_ms': float(median),
+                'threshold_ms': float(threshold),
+                **_attribute(loads, start, end),
+            }
+            if self._session_id is not None:
+                hitch['session'] = self._session_id
+            hitches.append(hitch)
+
+        self.num_hitches += len(hitches)
+        if self._log is not None:
+            for hitch in hitches:
+                self._log.write(hitch)
+
+        return hitches
+
+
+def _attribute(loads: np.ndarray, start: float, end: float) -> dict:
+    """Return the load_chunk events that happened between start and end.
+
+    Parameters
+    ----------
+    loads : np.ndarray
+        Rows of (time, load_ms, num_bytes).
+    start : float
+        Start of the frame.
+    end : float
+        End of the frame.
+    """
+    if len(loads) == 0:
+        return {'num_loads': 0, 'load_bytes': 0, 'max_load_ms': 0.0}
+
+    inside = (loads[:, 0] >= start) & (loads[:, 0] <= end)
+    window = loads[inside]
+    return {
+        'num_loads': int(len(window)),
+        'load_bytes': int(window[:, 2].sum()),
+        'max_load_ms': float(window[:, 1].max()) if len(window) else 0.0,
+    }
@@ -0,0 +1,194 @@
+//
+// charts.js
+//
+// Streaming support for the Vega-Lite charts in loader.js.
+//
+// Every chart shows a sliding window of points. The naive approach is a
+// changeset with remove(predicate), but Vega evaluates that predicate
+// against every tuple in the dataset on every push. Instead we remember
+// the tuples we inserted in a time-ordered ring, and remove the expired
+// ones by reference. Since time only moves forward the expired tuples are
+// always at the front of the ring.
+//
+// We call view.change() only once per run(). Vega keeps one pending
+// changeset per dataset, so a second change() before run() would replace
+// the first one, and requestAnimationFrame is paused in background tabs.
+// So push() accumulates the inserts and removes until the next run().
+//
+import vegaEmbed from 'vega-embed';
+import * as vega from "vega"
+
+// Sliding window shown by each chart.
+export const WINDOW_SECONDS = 10;
+export const GAP_SECONDS = 0.25;
+
+// Above this many points in one chart we switch from SVG to canvas, and
+// switch back to SVG when we drop below the lower threshold.
+const CANVAS_POINTS = 2000;
+const SVG_POINTS = 1000;
+
+// Above this many points in one chart we only insert every Nth point.
+const DECIMATE_POINTS = 5000;
+
+//
+// A growable circular buffer of tuples in time order.
+//
+class TupleRing {
+    constructor(capacity = 1024) {
+        this.items = new Array(capacity);
+        this.head = 0;
+        this.length = 0;
+    }
+
+    push(item) {
+        if (this.length === this.items.length) {
+            this.grow();
+        }
+        const index = (this.head + this.length) % this.items.length;
+        this.items[index] = item;
+        this.length++;
+    }
+
+    // Return the first tuple without removing it.
+    peek() {
+        return this.items[this.head];
+    }
+
+    // Remove and return the first tuple.
+    shift() {
+        const item = this.items[this.head];
+        this.items[this.head] = undefined;
+        this.head = (this.head + 1) % this.items.length;
+        this.length--;
+        return item;
+    }
+
+    // Remove and return all tuples older than keep_time.
+    expire(keep_time) {
+        const expired = [];
+        while (this.length > 0 && this.peek().time < keep_time) {
+            expired.push(this.shift());
+        }
+        return expired;
+    }
+
+    grow() {
+        const items = new Array(this.items.length * 2);
+        for (let i = 0; i < this.length; i++) {
+            items[i] = this.items[(this.head + i) % this.items.length];
+        }
+        this.items = items;
+        this.head = 0;
+    }
+}
+
+//
+// Runs all pending Vega views once per animation frame.
+//
+// Pushing data only accumulates changes for the view. The first push in a
+// frame schedules one requestAnimationFrame callback, which runs every
+// view that changed during that frame.
+//
+class ChartScheduler {
+    constructor() {
+        this.pending = new Set();
+        this.scheduled = false;
+    }
+
+    schedule(chart) {
+        this.pending.add(chart);
+        if (!this.scheduled) {
+            this.scheduled = true;
+            requestAnimationFrame(() => this.runPending());
+        }
+    }
+
+    runPending() {
+        this.scheduled = false;
+        const charts = this.pending;
+        this.pending = new Set();
+        for (const chart of charts) {
+            chart.run();
+        }
+    }
+}
+
+const scheduler = new ChartScheduler();
+
+//
+// One Vega-Lite chart showing a sliding window of (time, value) points.
+//
+export class StreamingChart {
+    constructor(view) {
+        this.view = view;
+        this.ring = new TupleRing();
+        this.renderer = 'svg';
+        this.stride = 1;  // Insert every Nth point when decimating.
+        this.skipped = 0;
+        this.inserts = new Set();  // Not yet given to the view.
+        this.removes = [];  // Given to the view, not yet removed.
+    }
+
+    push(entries) {
+        if (entries.length === 0) {
+            return;
+        }
+
+        for (const entry of entries) {
+            if (this.skipped++ % this.stride !== 0) {
+                continue;  // Decimated.
+            }
+            const tuple = {
+                time: entry.time,
+                x: entry.time % WINDOW_SECONDS,
+                y: entry.value
+            };
+            this.ring.push(tuple);
+            this.inserts.add(tuple);
+        }
+
+        const last = entries[entries.length - 1];
+        const keep_time = last.time - WINDOW_SECONDS + GAP_SECONDS;
+        for (const tuple of this.ring.expire(keep_time)) {
+            // If the view never saw the tuple just don't insert it.
+            if (!this.inserts.delete(tuple)) {
+                this.removes.push(tuple);
+            }
+        }
+
+        this.updateStride();
+        scheduler.schedule(this);
+    }
+
+    // Decimate once we have too many points, stop once we are back down.
+    updateStride() {
+        const count = this.ring.length * this.stride;
+        this.stride = Math.max(1, Math.ceil(count / DECIMATE_POINTS));
+    }
+
+    // Called by the scheduler once per animation frame.
+    run() {
+        const count = this.ring.length;
+        if (this.renderer === 'svg' && count > CANVAS_POINTS) {
+            this.setRenderer('canvas');
+        } else if (this.renderer === 'canvas' && count < SVG_POINTS) {
+            this.setRenderer('svg');
+        }
+        this.view.change('table',
+            vega.changeset().insert([...this.inserts]).remove(this.removes));
+        this.inserts = new Set();
+        this.removes = [];
+        this.view.run();
+    }
+
+    setRenderer(renderer) {
+        console.log("chart renderer", renderer, this.ring.length);
+        this.renderer = renderer;
+        this.view.renderer(renderer);
+    }
+
+    static async from_spec(id, spec) {
+        const res = await vegaEmbed(id, spec, { defaultStyle: true, renderer: 'svg' });
+        return new StreamingChart(res.view);
+    }
+}
@@ -0,0 +1,161 @@
+//
+// latency.js
+//
+// How stale is the frame we are displaying?
+//
+// Webmon stamps each frame with when it passed each hop, on webmon's
+// clock. We sync our clock to webmon's like NTP does, so we can add our
+// own receive time and compute the latency of every hop.
+//
+
+// How often we sync our clock with webmon.
+const SYNC_INTERVAL_MS = 2000;
+
+// Number of recent sync samples we keep, we fit the best quarter.
+const MAX_SYNC_SAMPLES = 32;
+
+// Need at least this many seconds between the best samples to fit drift,
+// like MIN_DRIFT_SPAN_SECONDS in lib/clock_sync.py.
+const MIN_DRIFT_SPAN_SECONDS = 10;
+
+// Number of recent frames we compute the percentiles over.
+const MAX_FRAMES = 600;
+
+// The hops we show, as [name, from stamp, to stamp].
+const HOPS = [
+    ['napari → webmon', 'napari', 'webmon_recv'],
+    ['webmon queue', 'webmon_recv', 'webmon_send'],
+    ['webmon → browser', 'webmon_send', 'browser_recv'],
+    ['total', 'napari', 'browser_recv'],
+];
+
+function nowSeconds() {
+    return Date.now() / 1000;
+}
+
+//
+// Estimate webmon's clock offset and drift relative to ours.
+//
+export class ClockSync {
+    constructor(socket) {
+        this.socket = socket;
+        this.samples = [];
+        this.offset = null;  // Webmon minus us, in seconds.
+        this.drift = 0;
+        this.referenceTime = 0;
+    }
+
+    start() {
+        this.sync();
+        window.setInterval(() => this.sync(), SYNC_INTERVAL_MS);
+    }
+
+    sync() {
+        const t0 = nowSeconds();
+        this.socket.emit('clock_sync', { t0 }, (reply) => {
+            this.addSample(reply.t0, reply.t1, reply.t2, nowSeconds());
+        });
+    }
+
+    addSample(t0, t1, t2, t3) {
+        this.samples.push({
+            time: (t0 + t3) / 2,
+            offset: ((t1 - t0) + (t2 - t3)) / 2,
+            delay: (t3 - t0) - (t2 - t1),
+        });
+        if (this.samples.length > MAX_SYNC_SAMPLES) {
+            this.samples.shift();
+        }
+        this.estimate();
+    }
+
+    // Fit offset and drift to the lowest delay samples.
+    estimate() {
+        const sorted = [...this.samples].sort((a, b) => a.delay - b.delay);
+        const best = sorted.slice(0, Math.max(1, Math.floor(sorted.length / 4)));
+
+        const meanTime = best.reduce((sum, s) => sum + s.time, 0) / best.length;
+        const meanOffset = best.reduce((sum, s) => sum + s.offset, 0) / best.length;
+
+        this.referenceTime = meanTime;
+        this.offset = meanOffset;
+        this.drift = 0;
+
+        const times = best.map((s) => s.time);
+        if (Math.max(...times) - Math.min(...times) < MIN_DRIFT_SPAN_SECONDS) {
+            return;  // Too close together to fit a slope.
+        }
+
+        let num = 0;
+        let den = 0;
+        for (const s of best) {
+            num += (s.time - meanTime) * (s.offset - meanOffset);
+            den += (s.time - meanTime) ** 2;
+        }
+        this.drift = num / den;
+    }
+
+    // Return our current time on webmon's clock.
+    webmonNow() {
+        const now = nowSeconds();
+        const offset = this.offset + this.drift * (now - this.referenceTime);
+        return now + offset;
+    }
+
+    get synced() {
+        return this.offset !== null;
+    }
+}
+
+function percentile(sorted, percent) {
+    const index = Math.min(sorted.length - 1, Math.floor(sorted.length * percent / 100));
+    return sorted[index];
+}
+
+//
+// Per-hop latency of recent frames, shown as a table.
+//
+export class LatencyStats {
+    constructor(clock, element) {
+        this.clock = clock;
+        this.element = element;
+        this.hops = new Map(HOPS.map(([name]) => [name, []]));
+    }
+
+    // Record the stamps of a frame we just received.
+    addFrame(stamps) {
+        if (!stamps || !this.clock.synced) {
+            return;
+        }
+        const all = { ...stamps, browser_recv: this.clock.webmonNow() };
+
+        for (const [name, from, to] of HOPS) {
+            if (all[from] === undefined || all[to] === undefined) {
+                continue;  // Napari did not send its time.
+            }
+            const values = this.hops.get(name);
+            values.push((all[to] - all[from]) * 1000);
+            if (values.length > MAX_FRAMES) {
+                values.shift();
+            }
+        }
+    }
+
+    render() {
+        let rows = '';
+        for (const [name, values] of this.hops) {
+            if (values.length === 0) {
+                continue;
+            }
+            const sorted = [...values].sort((a, b) => a - b);
+            const cells = [50, 90, 99].map(p => `<td class="px-2">${percentile(sorted, p).toFixed(1)}</td>`);
+            rows += `<tr><td class="px-2">${name}</td>${cells.join('')}</tr>`;
+        }
+        this.element.innerHTML =
+            '<tr><th class="px-2">latency ms</th><th>p50</th><th>p90</th><th>p99</th></tr>' + rows;
+    }
+
+    start() {
+        window.setInterval(() => this.render(), 1000);
+    }
+}
@@ -3,16 +3,16 @@
 //
 // Vega-Lite graphs about the ChunkLoader and other things.
 //
-import vegaEmbed from 'vega-embed';
 import io from 'socket.io-client';
-import * as vega from "vega"
+import { StreamingChart } from './charts.js';
+import { connectOptions, streamRows } from './messages.js';
 
 const namespace = '/test';
 const url = location.protocol + '//' + document.domain + ':' + location.port + namespace;
 
 const params = {
     namespace,
-    socket: io.connect(url),
+    socket: io.connect(url, connectOptions()),
 };
 
 params.socket.on('connect', () => {
@@ -29,37 +29,6 @@ params.socket.on('input_data_response', (msg) => {
     console.log("input_data_response", msg);
 });
 
-const window_seconds = 10;
-const gap_seconds = 0.25;
-
-class VegaChart {
-    constructor(view) {
-        this.view = view;
-    }
-
-    push(entries) {
-        var chart_entries = [];
-        for (var entry of entries) {
-            const mod_time = entry.time % window_seconds;
-            chart_entries.push({ time: entry.time, x: mod_time, y: entry.value });
-        }
-
-        console.log("chart_entries", chart_entries);
-
-        const last = chart_entries.length - 1;
-        const keep_time = chart_entries[last].time - window_seconds + gap_seconds;
-
-        this.view.change('table',
-            vega.changeset().insert(chart_entries)
-                .remove(entry => entry.time < keep_time)).run();
-    }
-
-    static async from_spec(id, spec) {
-        const res = await vegaEmbed(id, spec, { defaultStyle: true });
-        return new VegaChart(res.view, res.vega);
-    }
-}
-
 const bytes = {
     spec: 'static/specs/load_bytes.json',
     id: '#load_bytes'
@@ -81,9 +50,9 @@ function updateCharts() {
 }
 
 export async function startLoader() {
-    const frame_time_chart = await VegaChart.from_spec(frame_time.id, frame_time.spec);
-    const load_ms_chart = await VegaChart.from_spec(load_ms.id, load_ms.spec);
-    const bytes_chart = await VegaChart.from_spec(bytes.id, bytes.spec);
+    const frame_time_chart = await StreamingChart.from_spec(frame_time.id, frame_time.spec);
+    const load_ms_chart = await StreamingChart.from_spec(load_ms.id, load_ms.spec);
+    const bytes_chart = await StreamingChart.from_spec(bytes.id, bytes.spec);
     window.setInterval(updateCharts, 100);
 
     params.socket.on('chart_data', (msg) => {
@@ -92,7 +61,7 @@ export async function startLoader() {
             switch (key) {
                 case 'frame_time':
                     var entries = [];
-                    for (const entry of msg.frame_time) {
+                    for (const entry of streamRows(msg.frame_time)) {
                         entries.push({ time: entry.time, value: entry.delta_ms });
                     }
                     console.log("entries", entries);
@@ -101,7 +70,7 @@ export async function startLoader() {
                 case 'load_chunk':
                     var load_entries = [];
                     var byte_entries = [];
-                    for (const entry of msg.load_chunk) {
+                    for (const entry of streamRows(msg.load_chunk)) {
                         load_entries.push({ time: entry.time, value: entry.load_ms });
                         byte_entries.push({ time: entry.time, value: entry.num_bytes });
                     }
@@ -111,10 +80,19 @@ export async function startLoader() {
                     break;
             }
         }
-
-        params.socket.on('napari_message', (msg) => {
-            // Any messages from napari that's not chart data will come here,
-            // we don't expect anything yet.
-        });
-    })
+    });
+
+    params.socket.on('napari_message', (msg) => {
+        // Any messages from napari that's not chart data will come here,
+        // we don't expect anything yet.
+    });
+
+    params.socket.on('hitch', (hitch) => {
+        // Webmon found a frame much slower than recent frames.
+        console.log(
+            `hitch ${hitch.delta_ms.toFixed(1)}ms ` +
+            `(median ${hitch.median_ms.toFixed(1)}ms) ` +
+            `${hitch.num_loads} loads ${hitch.load_bytes} bytes`
+        );
+    });
 }
@@ -0,0 +1,76 @@
+//
+// messages.js
+//
+// Helpers for messages from webmon.
+//
+
+//
+// Return the socket.io connect options for this page.
+//
+// The page's "session" URL parameter picks which napari session we are
+// monitoring. Without one webmon gives us its default session.
+//
+export function connectOptions() {
+    const session = new URLSearchParams(location.search).get('session');
+    return session ? { query: { session } } : {};
+}
+
+// Typed arrays for the numpy dtypes webmon sends binary columns in. The
+// 64-bit integer arrays hold BigInts, which we convert to Numbers.
+const TYPED_ARRAYS = {
+    '<f8': Float64Array,
+    '<f4': Float32Array,
+    '<i8': BigInt64Array,
+    '<u8': BigUint64Array,
+    '<i4': Int32Array,
+    '<u4': Uint32Array,
+    '<i2': Int16Array,
+    '<u2': Uint16Array,
+    '|i1': Int8Array,
+    '|u1': Uint8Array,
+    '|b1': Uint8Array,
+};
+
+//
+// Return one column of an event stream as an array.
+//
+// A column is either a plain array, or binary {dtype, data} where data is
+// an ArrayBuffer of little-endian values.
+//
+function decodeColumn(column) {
+    if (Array.isArray(column)) {
+        return column;
+    }
+    const Type = TYPED_ARRAYS[column.dtype];
+    if (Type === undefined) {
+        console.log("unknown dtype", column.dtype);
+        return [];
+    }
+    const values = new Type(column.data);
+    if (Type === BigInt64Array || Type === BigUint64Array) {
+        return Array.from(values, Number);
+    }
+    return values;
+}
+
+//
+// Return the values of an event stream from chart_data as row objects.
+//
+// Webmon sends each stream as columns: {length, columns: {field: column}}.
+//
+export function streamRows(stream) {
+    const columns = {};
+    for (const field in stream.columns) {
+        columns[field] = decodeColumn(stream.columns[field]);
+    }
+
+    const rows = [];
+    for (let i = 0; i < stream.length; i++) {
+        const row = {};
+        for (const field in columns) {
+            row[field] = columns[field][i];
+        }
+        rows.push(row);
+    }
+    return rows;
+}
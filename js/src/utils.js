@@ -8,6 +8,7 @@
 import * as THREE from 'three';
 import { TrackballControls } from 'three/examples/jsm/controls/TrackballControls';
 import io from 'socket.io-client';
+import { connectOptions } from './messages.js';
 
 const ZOOM = 0.8;
 
@@ -43,7 +44,7 @@ export function defineInternalParams() {
 		// Connect to the Socket.IO server.
 		// The connection URL has the following format:
 		//     http[s]://<domain>:<port>[/<namespace>]
-		this.socket = io.connect(location.protocol + '//' + document.domain + ':' + location.port + this.namespace);
+		this.socket = io.connect(location.protocol + '//' + document.domain + ':' + location.port + this.namespace, connectOptions());
 	};
 }
 
@@ -22,6 +22,7 @@ import {
 	defineInternalParams,
 	initScene,
 } from './utils.js';
+import { ClockSync, LatencyStats } from './latency.js';
 
 const SHOW_AXES = true;  // Draw the axes (red=X green=Y).
 const SHOW_TILES = true;  // Draw the tiles themselves.
@@ -46,10 +47,21 @@ const CONTEXT_BORDER = 5;
 class ViewerControls {
 	constructor() {
 		this.show_grid = false;
+		this.seq = 0;
 	}
 
+	// Each command carries a seq and timestamp, so when napari acks it we
+	// can measure the round trip.
 	send() {
-		internalParams.socket.emit('send_command', this);
+		this.seq++;
+		internalParams.socket.emit('send_command', {
+			show_grid: this.show_grid,
+			meta: {
+				type: 'viewer_controls',
+				browser_seq: this.seq,
+				browser_time: Date.now() / 1000,
+			}
+		});
 	}
 }
 
@@ -268,6 +280,12 @@ export function connectSocketInput() {
 
 	document.addEventListener("DOMContentLoaded", function (event) {
 
+		// Show the per-hop latency of the frames we receive.
+		const clock = new ClockSync(internalParams.socket);
+		const latency = new LatencyStats(clock, document.getElementById('latency'));
+		clock.start();
+		latency.start();
+
 		// Connect invoked when a connection with the server setup.
 		internalParams.socket.on('connect', function () {
 			console.log("connect")
@@ -283,8 +301,16 @@ export function connectSocketInput() {
 			console.log("input_data_response", msg);
 		});
 
+		// Napari acked one of our commands, report the round trip.
+		internalParams.socket.on('command_ack', function (ack) {
+			const rtt_ms = Date.now() - ack.browser_time * 1000;
+			console.log("command_ack", ack.browser_seq, rtt_ms);
+			internalParams.socket.emit('command_rtt', { rtt_ms });
+		});
+
 		internalParams.socket.on('set_layer_data', function (msg) {
 			layerData = msg;
+			latency.addFrame(layerData.stamps);
 			console.log("set_layer_data", layerData.tile_state.corners[0][0]);
 		});
 	});
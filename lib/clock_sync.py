@@ -0,0 +1,121 @@
+"""ClockSync class.
+
+NTP-style estimate of the offset between our clock and a remote clock.
+
+We send our time t0. The remote records t1 when it receives our request
+and t2 when it replies. We record t3 when the reply arrives. Then:
+
+    offset = ((t1 - t0) + (t2 - t3)) / 2    # remote minus local
+    delay = (t3 - t0) - (t2 - t1)           # network round trip
+
+A sample with a smaller delay has a smaller error, so we estimate the
+offset from the lowest delay samples. With samples spread over time we
+also fit the drift, how fast the offset is changing.
+"""
+from collections import deque
+from typing import NamedTuple, Optional
+
+# Number of recent samples we keep.
+MAX_SAMPLES = 64
+
+# Fraction of the samples, those with the lowest delay, we fit.
+BEST_FRACTION = 0.25
+
+# Need at least this many seconds between the best samples to fit drift.
+MIN_DRIFT_SPAN_SECONDS = 10
+
+
+class ClockSample(NamedTuple):
+    """One request/reply exchange."""
+
+    local_time: float  # The midpoint of t0 and t3.
+    offset: float
+    delay: float
+
+
+class ClockSync:
+    """Estimate offset and drift of a remote clock relative to ours.
+
+    Attributes
+    ----------
+    offset : Optional[float]
+        Remote minus local seconds at local time reference_time, None until
+        we have any samples.
+    drift : float
+        How many seconds the offset changes per second.
+    """
+
+    def __init__(self):
+        self._samples = deque(maxlen=MAX_SAMPLES)
+        self.offset: Optional[float] = None
+        self.drift = 0.0
+        self.reference_time = 0.0
+
+    @property
+    def synced(self) -> bool:
+        return self.offset is not None
+
+    def add_sample(self, t0: float, t1: float, t2: float, t3: float) -> None:
+        """Add one exchange and update the estimate.
+
+        Parameters
+        ----------
+        t0 : float
+            Local time the request was sent.
+        t1 : float
+            Remote time the request was received.
+        t2 : float
+            Remote time the reply was sent.
+        t3 : float
+            Local time the reply was received.
+        """
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        delay = (t3 - t0) - (t2 - t1)
+        self._samples.append(ClockSample((t0 + t3) / 2, offset, delay))
+        self._estimate()
+
+    def to_local(self, remote_time: float) -> float:
+        """Convert a remote time to our clock.
+
+        Parameters
+        ----------
+        remote_time : float
+            A time from the remote clock.
+        """
+        if self.offset is None:
+            return remote_time  # Not synced, best we can do.
+        # Close enough to use remote_time as the local time for the drift.
+        elapsed = remote_time - self.reference_time
+        return remote_time - (self.offset + self.drift * elapsed)
+
+    def as_dict(self) -> dict:
+        best_delay = min((s.delay for s in self._samples), default=None)
+        return {
+            'offset': self.offset,
+            'drift': self.drift,
+            'samples': len(self._samples),
+            'best_delay': best_delay,
+        }
+
+    def _estimate(self) -> None:
+        """Fit offset and drift to the lowest delay samples."""
+        samples = sorted(self._samples, key=lambda s: s.delay)
+        best = samples[: max(1, int(len(samples) * BEST_FRACTION))]
+
+        times = [s.local_time for s in best]
+        mean_time = sum(times) / len(best)
+        mean_offset = sum(s.offset for s in best) / len(best)
+
+        self.reference_time = mean_time
+        self.offset = mean_offset
+        self.drift = 0.0
+
+        if max(times) - min(times) < MIN_DRIFT_SPAN_SECONDS:
+            return  # Too close together to fit a slope.
+
+        # Least squares slope of offset over time.
+        num = sum(
+            (s.local_time - mean_time) * (s.offset - mean_offset) for s in best
+        )
+        den = sum((s.local_time - mean_time) ** 2 for s in best)
+        self.drift = num / den
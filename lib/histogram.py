@@ -0,0 +1,120 @@
+"""Histogram class.
+"""
+import math
+from typing import Dict, List
+
+import numpy as np
+
+# Bucket i holds values in [BASE * GROWTH**(i-1), BASE * GROWTH**i), except
+# bucket 0 which holds everything below BASE.
+BASE = 0.01
+GROWTH = 1.1
+NUM_BUCKETS = 200  # Up to about 0.01 * 1.1**199 = 1.7e6.
+
+
+class Histogram:
+    """Streaming histogram with log spaced buckets.
+
+    Records any number of values in constant memory. Percentiles are
+    accurate to within the bucket width, which is 10% of the value.
+
+    Parameters
+    ----------
+    name : str
+        The name of the histogram like "napari_ms".
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.counts: List[int] = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def record(self, value: float) -> None:
+        """Record one value."""
+        self.counts[_bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def record_many(self, values: np.ndarray) -> None:
+        """Record an array of values at once."""
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+
+        # Clamp before casting, inf would cast to a garbage index.
+        indices = np.zeros(len(values), dtype=np.int64)
+        above = values >= BASE
+        buckets = np.log(values[above] / BASE) / math.log(GROWTH)
+        indices[above] = (
+            np.minimum(buckets, NUM_BUCKETS - 2).astype(np.int64) + 1
+        )
+
+        for i, count in enumerate(np.bincount(indices)):
+            self.counts[i] += int(count)
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other: "Histogram") -> None:
+        """Add the values recorded by the other histogram."""
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float) -> float:
+        """Return the value at this percentile, 0 if empty.
+
+        Parameters
+        ----------
+        percent : float
+            The percentile such as 50 or 99.
+        """
+        if self.count == 0:
+            return 0.0
+
+        target = self.count * percent / 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(max(_upper(i), self.min), self.max)
+        return self.max
+
+    def as_dict(self) -> Dict[str, float]:
+        """Return the summary statistics."""
+        if self.count == 0:
+            return {'count': 0}
+
+        return {
+            'count': self.count,
+            'mean': self.total / self.count,
+            'min': self.min,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+def _bucket(value: float) -> int:
+    """Return the bucket index for this value."""
+    if not value >= BASE:  # Also NaN.
+        return 0
+    if math.isinf(value):
+        return NUM_BUCKETS - 1
+    index = int(math.log(value / BASE, GROWTH)) + 1
+    return min(index, NUM_BUCKETS - 1)
+
+
+def _upper(index: int) -> float:
+    """Return the upper bound of this bucket."""
+    return BASE * GROWTH ** index
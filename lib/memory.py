@@ -0,0 +1,168 @@
+"""AllocationTracker class.
+
+Find where webmon's memory is going with tracemalloc.
+
+Tracing slows down every allocation, so it's off until someone starts it.
+Then take() records a snapshot and returns the top allocation sites, and
+how much each grew since the previous snapshot. Sites are grouped by
+module, so growth can be traced to a subsystem like "engineio.socket" or
+"streams" rather than to a single line.
+"""
+import os
+import sys
+import tracemalloc
+from collections import defaultdict
+from typing import Dict, Optional
+
+# Number of frames tracemalloc records for each allocation.
+DEFAULT_FRAMES = 1
+
+# Group modules by this many dotted components, "engineio.socket".
+DEFAULT_DEPTH = 2
+
+
+def _module(filename: str, depth: int) -> str:
+    """Return the dotted module name of this file, cut to depth components.
+
+    Parameters
+    ----------
+    filename : str
+        The path of the source file.
+    depth : int
+        Keep at most this many components.
+    """
+    if filename.startswith("<"):
+        return filename  # Like "<frozen importlib._bootstrap>".
+
+    best = ""
+    for path in sys.path:
+        path = os.path.abspath(path or os.curdir)
+        if filename.startswith(path + os.sep) and len(path) > len(best):
+            best = path
+
+    relative = filename[len(best) + 1 :] if best else filename
+    parts = os.path.splitext(relative)[0].split(os.sep)
+    if parts[-1] == "__init__" and len(parts) > 1:
+        parts.pop()
+    return ".".join(parts[:depth])
+
+
+def _by_module(stats, depth: int) -> Dict[str, dict]:
+    """Return the size and count of allocations grouped by module.
+
+    Parameters
+    ----------
+    stats : List[tracemalloc.Statistic] or List[tracemalloc.StatisticDiff]
+        Statistics grouped by filename.
+    depth : int
+        Group by this many dotted components.
+    """
+    modules = defaultdict(lambda: defaultdict(int))
+    for stat in stats:
+        module = modules[_module(stat.traceback[0].filename, depth)]
+        module['size'] += stat.size
+        module['count'] += stat.count
+        if isinstance(stat, tracemalloc.StatisticDiff):
+            module['size_diff'] += stat.size_diff
+            module['count_diff'] += stat.count_diff
+    return modules
+
+
+class AllocationTracker:
+    """Start and stop tracemalloc and compare its snapshots.
+
+    Attributes
+    ----------
+    _previous : Optional[tracemalloc.Snapshot]
+        The last snapshot we took, the next one is compared to it.
+    """
+
+    def __init__(self):
+        self._previous: Optional[tracemalloc.Snapshot] = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self, frames: int = DEFAULT_FRAMES) -> None:
+        """Start tracing allocations, forgetting any previous snapshot."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self._previous = None
+
+    def stop(self) -> None:
+        """Stop tracing, which frees all of tracemalloc's memory."""
+        tracemalloc.stop()
+        self._previous = None
+
+    def take(self, limit: int = 20, depth: int = DEFAULT_DEPTH) -> dict:
+        """Take a snapshot and return the top modules by size.
+
+        If we took a snapshot before, sort by growth since then instead.
+
+        Parameters
+        ----------
+        limit : int
+            Return at most this many modules.
+        depth : int
+            Group by this many dotted components of the module name.
+
+        Return
+        ------
+        dict
+            The traced memory and the top modules.
+        """
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("Not tracing, start tracing first.")
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+
+        if self._previous is None:
+            stats = snapshot.statistics('filename')
+            key = 'size'
+        else:
+            stats = snapshot.compare_to(self._previous, 'filename')
+            key = 'size_diff'
+        self._previous = snapshot
+
+        modules = _by_module(stats, depth)
+        top = sorted(
+            modules.items(), key=lambda item: abs(item[1][key]), reverse=True
+        )
+
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'traced_bytes': current,
+            'peak_bytes': peak,
+            'overhead_bytes': tracemalloc.get_tracemalloc_memory(),
+            'compared': key == 'size_diff',
+            'modules': [
+                {'module': name, **values} for name, values in top[:limit]
+            ],
+        }
+
+
+def encoded_size(encoded) -> int:
+    """Return the size of an encoded socketio packet in bytes.
+
+    Parameters
+    ----------
+    encoded : str, bytes or list
+        A packet with binary attachments encodes to a list.
+    """
+    if isinstance(encoded, list):
+        return sum(len(part) for part in encoded)
+    return len(encoded)
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """Return our peak resident set size in bytes, if we can tell."""
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
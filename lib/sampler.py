@@ -0,0 +1,178 @@
+"""Sampler class.
+
+A sampling profiler for webmon itself, so we can see where its time goes
+without restarting it under an external profiler.
+
+A Sampler is a thread that wakes up rate_hz times a second and records
+the stack of every other thread with sys._current_frames(). It only
+exists while a profile is running, so when idle it costs nothing.
+
+We produce two things:
+
+1) Collapsed stacks, one line per unique stack with its sample count,
+   the input flamegraph.pl and speedscope expect:
+
+       MainThread;run (webmon.py:240);_background_task (bridge.py:160) 12
+
+2) A per-function summary, how often each function was running itself
+   (self) or was anywhere on the stack (total).
+
+Notes
+-----
+The bridge background tasks and the socketio handlers are green threads
+which all run on the main thread. We see whichever green thread is
+running when we sample, which is the one using the CPU. The NapariClient
+is a real thread, standalone and ingest webmon don't monkey_patch.
+
+Worker processes do monkey_patch, which turns threading.Thread and
+time.sleep green. A green Sampler would only run when the others yield,
+and would mostly record itself. So we always use the original threading
+and time modules, the Sampler is a real OS thread either way.
+"""
+import os
+import sys
+from collections import Counter
+from typing import List
+
+try:
+    from eventlet.patcher import original
+
+    threading = original("threading")
+    time = original("time")
+except ImportError:
+    import threading
+    import time
+
+DEFAULT_RATE_HZ = 100
+MAX_RATE_HZ = 1000
+MAX_SECONDS = 60
+
+# Only one profile at a time, two samplers would sample each other.
+_running = threading.Lock()
+
+
+def _label(frame) -> str:
+    """Return the label for this frame's function."""
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def _stack(frame) -> List[str]:
+    """Return the labels of this frame's stack, outermost first."""
+    labels = []
+    while frame is not None:
+        labels.append(_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+class Sampler(threading.Thread):
+    """Sample the stacks of every thread for a while.
+
+    Parameters
+    ----------
+    rate_hz : float
+        Sample this many times a second.
+    seconds : float
+        Stop after this many seconds.
+
+    Attributes
+    ----------
+    stacks : Counter
+        The number of samples of each unique stack, by its collapsed
+        form "thread;outer;...;inner".
+    num_samples : int
+        How many times we sampled.
+    """
+
+    def __init__(self, rate_hz: float, seconds: float):
+        super().__init__(name="Sampler", daemon=True)
+        if not 0 < rate_hz <= MAX_RATE_HZ:
+            raise ValueError(f"rate_hz must be in (0, {MAX_RATE_HZ}]")
+        if not 0 < seconds <= MAX_SECONDS:
+            raise ValueError(f"seconds must be in (0, {MAX_SECONDS}]")
+        self.rate_hz = rate_hz
+        self.seconds = seconds
+        self.stacks: Counter = Counter()
+        self.num_samples = 0
+
+    def start(self) -> None:
+        """Start sampling, raise RuntimeError if already profiling."""
+        if not _running.acquire(blocking=False):
+            raise RuntimeError("A profile is already running.")
+        try:
+            super().start()
+        except Exception:
+            _running.release()
+            raise
+
+    def run(self) -> None:
+        try:
+            interval = 1 / self.rate_hz
+            next_time = time.perf_counter()
+            end = next_time + self.seconds
+            while next_time < end:
+                self._sample()
+                # Sleep until the next tick, sampling should not slow the rate.
+                next_time += interval
+                time.sleep(max(0, next_time - time.perf_counter()))
+        finally:
+            _running.release()
+
+    def _sample(self) -> None:
+        """Record the current stack of every thread but ours."""
+        names = {
+            thread.ident: thread.name for thread in threading.enumerate()
+        }
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self.ident:
+                continue
+            name = names.get(thread_id, str(thread_id))
+            self.stacks[";".join([name] + _stack(frame))] += 1
+        self.num_samples += 1
+
+    def collapsed(self) -> List[str]:
+        """Return the collapsed stacks, most sampled first."""
+        return [
+            f"{stack} {count}" for stack, count in self.stacks.most_common()
+        ]
+
+    def summary(self, limit: int = 50) -> List[dict]:
+        """Return the functions with the most samples.
+
+        Parameters
+        ----------
+        limit : int
+            Return at most this many functions.
+
+        Return
+        ------
+        List[dict]
+            {"function": str, "self": int, "total": int}, sorted by total.
+            The counts are summed over all threads.
+        """
+        self_counts = Counter()
+        total_counts = Counter()
+        for stack, count in self.stacks.items():
+            labels = stack.split(";")[1:]  # Without the thread name.
+            if not labels:
+                continue
+            self_counts[labels[-1]] += count
+            for label in set(labels):  # Count recursion once.
+                total_counts[label] += count
+
+        return [
+            {'function': label, 'self': self_counts[label], 'total': total}
+            for label, total in total_counts.most_common(limit)
+        ]
+
+    def as_dict(self) -> dict:
+        return {
+            'rate_hz': self.rate_hz,
+            'seconds': self.seconds,
+            'num_samples': self.num_samples,
+            'functions': self.summary(),
+            'collapsed': self.collapsed(),
+        }
@@ -0,0 +1,240 @@
+"""SharedArrays class.
+
+Large arrays like tile_state can be too big to pickle through napari_data
+every frame. Instead napari can put the array in a named SharedMemory
+segment, and only put a small descriptor in napari_data:
+
+    {
+        "shared_array": {
+            "name": "psm_1f2e3d",   # The SharedMemory segment name.
+            "dtype": "<i4",         # Anything np.dtype() accepts.
+            "shape": [1024, 2],
+            "generation": 17,       # Incremented when napari writes.
+        }
+    }
+
+SharedArrays replaces each descriptor with a zero-copy numpy view of the
+segment. We keep each segment mapped across frames, and if the descriptor
+did not change we return the same view as last frame.
+
+Napari owns the segments. It creates them with its SharedMemoryManager
+whose process unlinks them when napari exits, even if napari crashes. We
+only ever close our own mappings, we never unlink.
+
+Closing a mapping while a view of it exists would crash the process the
+next time the view is read. The NapariClient thread resolves and closes,
+while the bridge may still be encoding last frame's views. So we keep a
+weak reference to every view we hand out, and close a segment we no
+longer need only once all of its views are gone.
+"""
+import logging
+import sys
+import weakref
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+LOGGER = logging.getLogger("webmon")
+
+DESCRIPTOR_KEY = "shared_array"
+
+
+class SharedArrayInfo(NamedTuple):
+    """A parsed "shared_array" descriptor."""
+
+    name: str
+    dtype: str
+    shape: tuple
+    generation: int
+
+    @classmethod
+    def from_dict(cls, desc: dict) -> "SharedArrayInfo":
+        return cls(
+            desc['name'],
+            desc['dtype'],
+            tuple(desc['shape']),
+            desc.get('generation', 0),
+        )
+
+
+def _attach(name: str) -> SharedMemory:
+    """Attach to an existing segment without tracking it.
+
+    The resource tracker would unlink the segment when we exit, but it's
+    napari's segment not ours. Python 3.13 added track=False for this.
+    """
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+
+    segment = SharedMemory(name=name)
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+class SharedArrays:
+    """Numpy views of napari's SharedMemory segments.
+
+    Attributes
+    ----------
+    _segments : Dict[str, SharedMemory]
+        The segments we have mapped by name.
+    _views : Dict[str, Tuple[SharedArrayInfo, np.ndarray]]
+        The latest view of each segment and the descriptor it came from.
+    _refs : Dict[str, List[weakref.ref]]
+        Every view of each segment we handed out that might still exist.
+    _closing : List[Tuple[SharedMemory, List[weakref.ref]]]
+        Segments we could not close yet because views still exist.
+    """
+
+    def __init__(self):
+        self._segments: Dict[str, SharedMemory] = {}
+        self._views: Dict[str, Tuple[SharedArrayInfo, np.ndarray]] = {}
+        self._refs: Dict[str, List[weakref.ref]] = {}
+        self._closing: List[Tuple[SharedMemory, List[weakref.ref]]] = []
+
+    def resolve(self, data):
+        """Return data with every descriptor replaced by a numpy view.
+
+        Segments napari stopped referencing are closed.
+
+        Parameters
+        ----------
+        data
+            Data from napari_data, any mix of dicts and lists.
+        """
+        used = set()
+        resolved = self._resolve(data, used)
+
+        for name in list(self._segments):
+            if name not in used:
+                self._release(name)
+        self._close_pending()
+
+        return resolved
+
+    def close(self) -> None:
+        """Close all our mappings, napari is gone.
+
+        Mappings that still have views stay open, we leak them rather
+        than crash whoever holds the views.
+        """
+        for name in list(self._segments):
+            self._release(name)
+        self._close_pending()
+
+        if self._closing:
+            LOGGER.warning(
+                "SharedArrays: %d segments still in use", len(self._closing)
+            )
+
+    def as_dict(self) -> dict:
+        """Return how many segments we have mapped and their size."""
+        segments = list(self._segments.values())
+        return {
+            'segments': len(segments),
+            'mapped_bytes': sum(segment.size for segment in segments),
+            'closing': len(self._closing),
+        }
+
+    def _resolve(self, data, used: set):
+        """Recursively replace descriptors in data."""
+        if isinstance(data, dict):
+            desc = data.get(DESCRIPTOR_KEY)
+            if isinstance(desc, dict) and len(data) == 1:
+                return self._view(SharedArrayInfo.from_dict(desc), used)
+            return {
+                key: self._resolve(value, used) for key, value in data.items()
+            }
+
+        if isinstance(data, list):
+            return [self._resolve(value, used) for value in data]
+
+        return data
+
+    def _view(self, info: SharedArrayInfo, used: set) -> Optional[np.ndarray]:
+        """Return a numpy view of the described segment.
+
+        Parameters
+        ----------
+        info : SharedArrayInfo
+            The segment and how to interpret it.
+        used : set
+            We add the segment name to this set.
+
+        Return
+        ------
+        Optional[np.ndarray]
+            The view or None if the segment no longer exists or the
+            descriptor does not fit it.
+        """
+        cached = self._views.get(info.name)
+        if cached is not None and cached[0] == info:
+            used.add(info.name)
+            return cached[1]  # Same as last frame.
+
+        segment = self._segments.get(info.name)
+        if segment is None:
+            try:
+                segment = _attach(info.name)
+            except FileNotFoundError:
+                LOGGER.error("SharedArrays: %s does not exist", info.name)
+                return None
+            self._segments[info.name] = segment
+            LOGGER.info("SharedArrays: mapped %s", info.name)
+        used.add(info.name)
+
+        try:
+            dtype = np.dtype(info.dtype)
+            nbytes = dtype.itemsize * int(np.prod(info.shape, dtype=np.int64))
+        except (TypeError, ValueError) as error:
+            LOGGER.error("SharedArrays: bad descriptor %s: %s", info, error)
+            return None
+        if min(info.shape, default=0) < 0 or nbytes > segment.size:
+            LOGGER.error(
+                "SharedArrays: %s is %d bytes, too small for %s",
+                info.name,
+                segment.size,
+                info,
+            )
+            return None
+
+        view = np.ndarray(info.shape, dtype=dtype, buffer=segment.buf)
+        view.flags.writeable = False  # It's napari's data.
+        self._views[info.name] = (info, view)
+
+        refs = self._refs.setdefault(info.name, [])
+        refs[:] = [ref for ref in refs if ref() is not None]
+        refs.append(weakref.ref(view))
+        return view
+
+    def _release(self, name: str) -> None:
+        """We no longer need this segment, close it once it has no views.
+
+        Parameters
+        ----------
+        name : str
+            The name of the segment.
+        """
+        self._views.pop(name, None)
+        segment = self._segments.pop(name)
+        self._closing.append((segment, self._refs.pop(name, [])))
+
+    def _close_pending(self) -> None:
+        """Close the segments that no longer have views.
+
+        Slices and other views of our views keep our views alive through
+        their base, so a dead weak reference means no view is left.
+        """
+        still_open = []
+        for segment, refs in self._closing:
+            if any(ref() is not None for ref in refs):
+                still_open.append((segment, refs))  # A view still exists.
+                continue
+            try:
+                segment.close()
+                LOGGER.info("SharedArrays: closed %s", segment.name)
+            except BufferError:
+                still_open.append((segment, refs))
+        self._closing = still_open
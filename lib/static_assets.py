@@ -0,0 +1,204 @@
+"""StaticAssets class.
+
+Serve the static files compressed and cacheable, we often reach webmon
+over a slow tunnel and the esbuild bundles are megabytes.
+
+Each file gets a content hash. Pages link to /static/<file>?v=<hash>, and
+a request with the current hash is cached by the browser forever, because
+a new build gets a new hash and so a new URL. Requests without the hash,
+like the chunks the bundles import, are revalidated with an ETag.
+
+Compressible files are sent with brotli or gzip if the browser accepts
+them. "make build" writes <file>.br and <file>.gz next to each file with
+precompress(). Files without them are compressed once in memory on first
+request. Brotli is only used if the brotli module is installed.
+"""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import sys
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+LOGGER = logging.getLogger("webmon")
+
+# Files worth compressing, images are compressed already.
+COMPRESS_SUFFIXES = {".js", ".css", ".json", ".html", ".svg", ".map"}
+
+# Most preferred first.
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+
+# A year, the longest the spec allows.
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def _encodings() -> Dict[str, str]:
+    """Return the encodings we can produce."""
+    if brotli is None:
+        return {"gzip": ENCODINGS["gzip"]}
+    return ENCODINGS
+
+
+class StaticAsset:
+    """One static file, its hash and its compressed versions.
+
+    Parameters
+    ----------
+    path : Path
+        The file.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.mtime = path.stat().st_mtime
+        self.data = path.read_bytes()
+        self.hash = hashlib.sha256(self.data).hexdigest()[:16]
+        self.mimetype = (
+            mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        )
+        self.encoded: Dict[str, bytes] = {}
+
+        if path.suffix in COMPRESS_SUFFIXES:
+            for encoding, suffix in _encodings().items():
+                self.encoded[encoding] = self._load(encoding, suffix)
+
+    def _load(self, encoding: str, suffix: str) -> bytes:
+        """Return the precompressed file, or compress it ourselves."""
+        compressed = self.path.with_name(self.path.name + suffix)
+        try:
+            if compressed.stat().st_mtime >= self.mtime:
+                return compressed.read_bytes()
+        except OSError:
+            pass  # No precompressed file.
+        return _compress(self.data, encoding)
+
+    def body(self, accept_encodings) -> Tuple[bytes, Optional[str]]:
+        """Return the best body for the browser, and its encoding.
+
+        Parameters
+        ----------
+        accept_encodings : werkzeug.datastructures.Accept
+            The request's Accept-Encoding header.
+        """
+        for encoding, data in self.encoded.items():
+            if encoding in accept_encodings and len(data) < len(self.data):
+                return data, encoding
+        return self.data, None
+
+
+class StaticAssets:
+    """All the files in the static folder.
+
+    Parameters
+    ----------
+    folder : str
+        The static folder.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = Path(folder).resolve()
+        self._assets: Dict[str, StaticAsset] = {}
+
+    def get(self, filename: str) -> Optional[StaticAsset]:
+        """Return the asset or None if there is no such file.
+
+        We reload the asset if the file changed, so a rebuild while webmon
+        is running is picked up.
+
+        Parameters
+        ----------
+        filename : str
+            The path of the file relative to the static folder.
+        """
+        path = (self.folder / filename).resolve()
+        if self.folder not in path.parents or not path.is_file():
+            return None  # Outside the folder or not a file.
+
+        asset = self._assets.get(filename)
+        if asset is None or asset.mtime != path.stat().st_mtime:
+            asset = self._assets[filename] = StaticAsset(path)
+        return asset
+
+    def url(self, filename: str) -> str:
+        """Return the URL of the file with its content hash.
+
+        Parameters
+        ----------
+        filename : str
+            The path of the file relative to the static folder.
+        """
+        asset = self.get(filename)
+        if asset is None:
+            LOGGER.warning("Missing static file %s", filename)
+            return f"/static/{filename}"
+        return f"/static/{filename}?v={asset.hash}"
+
+    def response(self, filename: str, request, response_class):
+        """Return the response for this request, None if no such file.
+
+        Parameters
+        ----------
+        filename : str
+            The path of the file relative to the static folder.
+        request : flask.Request
+            The request for the file.
+        response_class : type
+            The flask Response class.
+        """
+        asset = self.get(filename)
+        if asset is None:
+            return None
+
+        data, encoding = asset.body(request.accept_encodings)
+        response = response_class(data, mimetype=asset.mimetype)
+
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
+        if asset.encoded:
+            response.headers["Vary"] = "Accept-Encoding"
+
+        if request.args.get("v") == asset.hash:
+            response.headers["Cache-Control"] = IMMUTABLE
+        else:
+            response.headers["Cache-Control"] = REVALIDATE
+
+        response.set_etag(f"{asset.hash}-{encoding or 'identity'}")
+        return response.make_conditional(request)
+
+
+def precompress(folder: str) -> None:
+    """Write compressed versions of the compressible files in the folder.
+
+    Parameters
+    ----------
+    folder : str
+        The static folder.
+    """
+    for root, _, filenames in os.walk(folder):
+        for filename in filenames:
+            path = Path(root) / filename
+            if path.suffix not in COMPRESS_SUFFIXES:
+                continue
+            data = path.read_bytes()
+            for encoding, suffix in _encodings().items():
+                compressed = _compress(data, encoding)
+                path.with_name(filename + suffix).write_bytes(compressed)
+            print(f"Compressed {path}")
+
+
+if __name__ == "__main__":
+    precompress(sys.argv[1] if len(sys.argv) > 1 else "static")
@@ -1,6 +1,15 @@
 """NapariClient class.
 
 A shared memory client for napari, for use inside webmon.
+
+Every call on the SharedMemoryManager proxies is a blocking socket call.
+Webmon does not monkey_patch() so a blocking call on the eventlet hub
+would stall every websocket client. So only the NapariClient thread,
+which is a real OS thread, touches the proxies. The rest of webmon talks
+to that thread through deques and plain attribute reads, which never block.
+
+That includes connecting, the thread connects to napari itself. A napari
+that is slow to accept would otherwise stall the hub too.
 """
 import base64
 import json
@@ -8,12 +17,15 @@ import logging
 import os
 import threading
 import time
+from collections import deque
 from multiprocessing.managers import SharedMemoryManager
 from queue import Empty, Queue
 from threading import Event, Thread
 from typing import Callable, NamedTuple, Optional
 
+from lib.clock_sync import ClockSync
 from lib.numpy_json import NumpyJSON
+from lib.shared_arrays import SharedArrays
 
 LOGGER = logging.getLogger("webmon")
 
@@ -28,6 +40,22 @@ LOG_DATA_FROM_NAPARI = False
 POLL_INTERVAL_MS = 16.7
 POLL_INTERVAL_SECONDS = POLL_INTERVAL_MS / 1000
 
+# The keys in napari_data that we fetch every poll.
+NAPARI_DATA_KEYS = ['poll']
+
+# How often we send napari a clock_sync request. Napari replies with
+# {"clock_sync": {"t0": t0, "t1": received, "t2": replied}}.
+CLOCK_SYNC_SECONDS = 1
+CLOCK_SYNC_KEY = "clock_sync"
+
+# Napari treats every top-level key of our messages as a command, and logs
+# an error for keys it does not know. So newer napari builds announce what
+# they understand with {"monitor_features": ["command_ack", ...]}, and until
+# they do we only send plain commands.
+FEATURES_KEY = "monitor_features"
+FEATURE_COMMAND_ACK = "command_ack"  # Napari acks commands with a meta.
+FEATURE_CLOCK_SYNC = "clock_sync"  # Napari replies to clock_sync.
+
 
 class NapariRemoteAPI(NamedTuple):
     """Napari exposes these shared resources.
@@ -63,7 +91,7 @@ class NapariRemoteAPI(NamedTuple):
         )
 
 
-def _get_client_config() -> dict:
+def get_client_config() -> Optional[dict]:
     """Get config information from napari.
 
     Napari passes us a base64 encoded JSON blob in an environment variable.
@@ -72,8 +100,8 @@ def _get_client_config() -> dict:
 
     Return
     ------
-    dict
-        The parsed configuration.
+    Optional[dict]
+        The parsed configuration or None if not defined.
     """
     env_str = os.getenv("NAPARI_MON_CLIENT")
     if env_str is None:
@@ -110,6 +138,26 @@ class NapariClient(Thread):
         The parsed configuration from the NAPARI_MON_CLIENT env variable.
     on_shutdown : Callable[[], None]
         We call then when shutting down.
+
+    Attributes
+    ----------
+    _napari_data : dict
+        The latest value of each NAPARI_DATA_KEYS key. Our thread replaces
+        the values, so a reader always sees a whole value.
+    _inbox : deque
+        Messages from napari our thread received.
+    _outbox : deque
+        Messages to napari our thread will send.
+    _shared_arrays : SharedArrays
+        Maps the shared_array descriptors in napari_data to numpy views.
+    _received : dict
+        The time we fetched each NAPARI_DATA_KEYS key.
+    clock : ClockSync
+        Napari's clock relative to ours.
+    features : frozenset
+        The FEATURES_KEY features napari announced.
+    connect_error : Optional[Exception]
+        Why our thread could not connect to napari, if it could not.
     """
 
     def __init__(self, config: dict, on_shutdown: Callable[[], None]):
@@ -117,11 +165,28 @@ class NapariClient(Thread):
         self.config = config
         self._on_shutdown = on_shutdown
         self._running = False
+        self._stop_requested = Event()
+        self._napari_data = {}
+        self._inbox = deque()
+        self._outbox = deque()
+        self._shared_arrays = SharedArrays()
+        self._received = {}
+        self._last_clock_sync = 0.0
+        self._manager = None
+        self._remote = None
+        self.clock = ClockSync()
+        self.features = frozenset()
+        self.connect_error: Optional[Exception] = None
 
         LOGGER.info("Starting process %s", os.getpid())
         _log_env()  # Log our startup environment.
 
-        server_port = config['server_port']
+        # Start our thread which will connect to napari and poll it.
+        self.start()
+
+    def _connect(self) -> None:
+        """Connect to napari's shared memory, raise if we cannot."""
+        server_port = self.config['server_port']
         LOGGER.info("Connecting to napari on port %d.", server_port)
 
         # We have to register these before creating the SharedMemoryManager.
@@ -133,7 +198,7 @@ class NapariClient(Thread):
         # Connect to napari's shared memory on the server_port that napari
         # passed us in our NAPARI_MON_CLIENT configuration.
         self._manager = SharedMemoryManager(
-            address=('localhost', config['server_port']),
+            address=('localhost', server_port),
             authkey=str.encode('napari'),
         )
         self._manager.connect()
@@ -141,9 +206,6 @@ class NapariClient(Thread):
         # Get the shared resources as a convenient named tuple.
         self._remote = NapariRemoteAPI.from_manager(self._manager)
 
-        # Start our thread which will poll napari.
-        self.start()
-
     def run(self) -> None:
         """Thread that communicates with napari.
 
@@ -155,28 +217,52 @@ class NapariClient(Thread):
         Which is fine for now. But a graceful handshake-exit might be
         something to look into. Obviously napari should have a short
         timeout so if the client is hung, it still exits quickly.
-        """
 
-        self._running = True
+        If we cannot connect we set connect_error and exit without calling
+        on_shutdown, we never talked to napari.
+        """
         tid = threading.get_ident()
         LOGGER.info("Started NapariClient.run with thread_id = %d.", tid)
 
-        while True:
+        try:
+            self._connect()
+        except (ConnectionError, OSError) as error:
+            LOGGER.info("Cannot connect to napari: %s", error)
+            self.connect_error = error
+            return
+
+        self._running = True
+
+        try:
+            self._poll_until_done()
+        finally:
+            # Even on an unexpected error, so the session can reconnect.
+            LOGGER.info("Thread %d is exiting.", tid)
+
+            # Drop our views and close our shared memory mappings.
+            self._napari_data = {}
+            self._shared_arrays.close()
+
+            # Notify webmon that we shutdown.
+            self._running = False
+            self._on_shutdown()
+
+    def _poll_until_done(self) -> None:
+        """Poll until napari shuts down, disconnects or we are stopped."""
+        while not self._stop_requested.is_set():
             try:
                 if not self._poll():
-                    break  # Shutdown event, exit the thread.
-            except ConnectionResetError:
-                LOGGER.info("ConnectionResetError polling napari.")
-                break  # Napari exited, exit the thread.
+                    return  # Shutdown event, exit the thread.
+            except (ConnectionError, EOFError) as error:
+                LOGGER.info("%s polling napari.", type(error).__name__)
+                return  # Napari exited, exit the thread.
 
             # Sleep until ready to poll again.
             time.sleep(POLL_INTERVAL_SECONDS)
 
-        LOGGER.info("Thread %d is exiting.", tid)
-
-        # Notify webmon that we shutdown.
-        self._running = False
-        self._on_shutdown()
+    def stop(self) -> None:
+        """Stop polling napari, the thread will exit soon."""
+        self._stop_requested.set()
 
     def _poll(self) -> bool:
         """Communicate with napari.
@@ -190,27 +276,111 @@ class NapariClient(Thread):
             LOGGER.info("Napari signaled shutdown.")
             return False  # Stop polling.
 
+        self._receive_messages()
+        self._send_messages()
+        self._send_clock_sync()
+
+        for key in NAPARI_DATA_KEYS:
+            data = self._remote.napari_data.get(key)
+            self._napari_data[key] = self._shared_arrays.resolve(data)
+            self._received[key] = time.time()
+
         return True  # Keep polling.
 
+    def _receive_messages(self) -> None:
+        """Move all of napari's messages into our inbox."""
+        napari_messages = self._remote.napari_messages
+
+        while True:
+            try:
+                message = napari_messages.get_nowait()
+            except Empty:
+                return  # No more messages in the queue.
+
+            assert isinstance(message, dict)  # For now.
+
+            if CLOCK_SYNC_KEY in message:
+                self._on_clock_sync(message[CLOCK_SYNC_KEY])
+            elif FEATURES_KEY in message:
+                self.features = frozenset(message[FEATURES_KEY])
+                LOGGER.info("Napari features: %s", sorted(self.features))
+            else:
+                self._inbox.append(message)
+
+    def _send_clock_sync(self) -> None:
+        """Send napari a clock_sync request every CLOCK_SYNC_SECONDS."""
+        if FEATURE_CLOCK_SYNC not in self.features:
+            return  # Napari would log an unknown command error.
+
+        now = time.time()
+        if now - self._last_clock_sync >= CLOCK_SYNC_SECONDS:
+            self._last_clock_sync = now
+            self._remote.client_messages.put({CLOCK_SYNC_KEY: {"t0": now}})
+
+    def _on_clock_sync(self, reply: dict) -> None:
+        """Napari replied to a clock_sync request.
+
+        We only notice the reply when we poll, so the measured delay
+        includes up to one poll interval. The delay filtering in ClockSync
+        prefers the replies we noticed soonest.
+        """
+        try:
+            self.clock.add_sample(
+                reply['t0'], reply['t1'], reply['t2'], time.time()
+            )
+        except KeyError:
+            LOGGER.error("Bad clock_sync reply: %s", reply)
+
+    def _send_messages(self) -> None:
+        """Send all the messages in our outbox to napari."""
+        while self._outbox:
+            message = self._outbox.popleft()
+            LOGGER.info("Sending message %s", message)
+            self._remote.client_messages.put(message)
+
     def get_napari_data(self, key):
-        """Get data from napari shared dict."""
-        return self._remote.napari_data.get(key)
+        """Get the latest data from napari shared dict, non-blocking.
+
+        Parameters
+        ----------
+        key : str
+            One of the NAPARI_DATA_KEYS.
+        """
+        return self._napari_data.get(key)
+
+    def get_received_time(self, key) -> Optional[float]:
+        """Return the time we fetched this key from napari_data.
+
+        Parameters
+        ----------
+        key : str
+            One of the NAPARI_DATA_KEYS.
+        """
+        return self._received.get(key)
 
     def send_message(self, message: dict) -> None:
-        """Send new message to napari.
+        """Send new message to napari, non-blocking.
+
+        Our thread sends the message the next time it polls.
 
         Parameters
         ----------
         message : dict
             The message/command to send to napari.
         """
-        LOGGER.info("Sending message %s", message)
+        if not self._running:
+            LOGGER.error("Cannot send message, napari is gone: %s", message)
+            return
 
-        try:
-            # Put message into the queue.
-            self._remote.client_messages.put(message)
-        except ConnectionRefusedError:
-            LOGGER.error("ConnectionRefusedError sending message to napari.")
+        self._outbox.append(message)
+
+    def memory(self) -> dict:
+        """Return the sizes of our queues and shared memory mappings."""
+        return {
+            'inbox': len(self._inbox),
+            'outbox': len(self._outbox),
+            'shared_arrays': self._shared_arrays.as_dict(),
+        }
 
     def get_one_napari_message(self) -> Optional[dict]:
         """Get one message from napari, non-blocking.
@@ -220,24 +390,10 @@ class NapariClient(Thread):
         Optional[dict]
             The message or None if no message was available.
         """
-        if not self._running:
-            return None  # Can't get messages from napari.
-
-        napari_messages = self._remote.napari_messages
-
         try:
-            message = napari_messages.get_nowait()
-            assert isinstance(message, dict)  # For now.
-            return message
-
-        except ConnectionResetError:
-            LOGGER.error("ConnectionResetError getting messages from napari")
-            # Napari is probably gone, but we let NapariClient._poll()
-            # notice this and exit. We just say there as no message.
-            return None
-
-        except Empty:
-            return None  # No message in the queue.
+            return self._inbox.popleft()
+        except IndexError:
+            return None  # No message in the inbox.
 
     @classmethod
     def create(cls, on_shutdown: Callable[[], None]):
@@ -253,7 +409,7 @@ class NapariClient(Thread):
         Optional[NapariClient]
             The newly created client or None on error.
         """
-        config = _get_client_config()
+        config = get_client_config()
         if config is None:
             return None
         LOGGER.info("Creating NapariClient pid=%s", os.getpid())
@@ -0,0 +1,314 @@
+"""SessionPool class.
+
+Monitor several napari instances from one webmon process.
+
+Each napari instance is a session with its own NapariClient, its own
+NapariBridge and its own socketio room. Web clients pick a session with
+the "session" query parameter, for example /loader?session=napari2, or
+get DEFAULT_SESSION if they don't pick one.
+
+Sessions come from three places:
+
+1) The NAPARI_MON_CLIENT environment variable, when napari launched us.
+2) Config files in the --sessions_dir directory, one JSON file per
+   session named <session_id>.json, with the same contents as the
+   NAPARI_MON_CLIENT config.
+3) The /sessions HTTP endpoints.
+
+When a session's napari exits the session stays in the pool, and we keep
+trying to reconnect to it until the session is removed.
+"""
+import json
+import logging
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from flask_socketio import SocketIO
+
+from bridge import NapariBridge
+from capture import Capture
+from hitches import HitchLog
+from napari_client import NapariClient
+
+LOGGER = logging.getLogger("webmon")
+
+# The session of the napari that launched us, and of web clients that
+# don't ask for a specific session.
+DEFAULT_SESSION = "default"
+
+# How often we scan the sessions directory and try to reconnect.
+MONITOR_INTERVAL_SECONDS = 2
+
+
+class Session:
+    """One napari instance we are monitoring.
+
+    Parameters
+    ----------
+    session_id : str
+        The session's id, also the name of its socketio room.
+    config : dict
+        The NAPARI_MON_CLIENT style config with the server_port.
+    bridge : NapariBridge
+        The bridge for this session.
+    source : str
+        Where the session came from: "env", "dir" or "api".
+    on_shutdown : Optional[Callable[[], None]]
+        If given we call this when napari exits, and do not reconnect.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        config: dict,
+        bridge: NapariBridge,
+        source: str,
+        on_shutdown: Optional[Callable[[], None]] = None,
+    ):
+        self.session_id = session_id
+        self.config = config
+        self.bridge = bridge
+        self.source = source
+        self.client: Optional[NapariClient] = None
+        self._on_shutdown_callback = on_shutdown
+
+    @property
+    def should_connect(self) -> bool:
+        """True if we should try to connect now.
+
+        Sessions with an on_shutdown callback only connect once, but they
+        retry until that one connection succeeds.
+        """
+        if self.client is not None and self.client.connect_error is not None:
+            return True  # The last attempt failed.
+        if self._on_shutdown_callback is not None:
+            return self.client is None
+        return not self.connected
+
+    @property
+    def connected(self) -> bool:
+        return self.client is not None and self.client.is_alive()
+
+    def connect(self) -> None:
+        """Start connecting to napari.
+
+        The NapariClient connects in its own thread, if that fails it sets
+        its connect_error and we try again later.
+        """
+        if self.client is not None and self.client.connect_error is not None:
+            LOGGER.info(
+                "Session %s: cannot connect: %s",
+                self.session_id,
+                self.client.connect_error,
+            )
+
+        self.client = NapariClient(self.config, self._on_shutdown)
+        self.bridge.set_client(self.client)
+        LOGGER.info("Session %s: connecting.", self.session_id)
+
+    def _on_shutdown(self) -> None:
+        """Our NapariClient exited, we'll try to reconnect later.
+
+        This is called in the NapariClient's thread.
+        """
+        LOGGER.info("Session %s: napari exited.", self.session_id)
+        self.bridge.set_client(None)
+
+        if self._on_shutdown_callback is not None:
+            self._on_shutdown_callback()
+
+    def close(self) -> None:
+        """Stop talking to napari, the session is being removed."""
+        self._on_shutdown_callback = None  # Don't stop webmon too.
+        self.bridge.stop()
+        if self.client is not None:
+            self.client.stop()
+
+    def as_dict(self) -> dict:
+        clock = None if self.client is None else self.client.clock.as_dict()
+        return {
+            'session_id': self.session_id,
+            'server_port': self.config.get('server_port'),
+            'source': self.source,
+            'connected': self.connected,
+            'napari_clock': clock,
+        }
+
+
+class SessionPool:
+    """All the napari sessions we are monitoring.
+
+    Parameters
+    ----------
+    socketio : SocketIO
+        The main SocketIO instance.
+    sessions_dir : Optional[str]
+        Directory of session config files.
+    hitch_log : Optional[HitchLog]
+        Every session writes the hitches it detects to this log.
+    capture : Optional[Capture]
+        Every session records napari's streams to this capture.
+    """
+
+    def __init__(
+        self,
+        socketio: SocketIO,
+        sessions_dir: Optional[str] = None,
+        hitch_log: Optional[HitchLog] = None,
+        capture: Optional[Capture] = None,
+    ):
+        self._socketio = socketio
+        self._sessions_dir = sessions_dir
+        self._hitch_log = hitch_log
+        self._capture = capture
+        self._sessions: Dict[str, Session] = {}
+        self._started = False
+
+    def add(
+        self,
+        session_id: str,
+        config: dict,
+        source: str = "api",
+        on_shutdown: Optional[Callable[[], None]] = None,
+    ) -> Session:
+        """Add a session, replacing any existing one with the same id.
+
+        Parameters
+        ----------
+        session_id : str
+            The id of the new session.
+        config : dict
+            The NAPARI_MON_CLIENT style config with the server_port.
+        source : str
+            Where the session came from: "env", "dir" or "api".
+        on_shutdown : Optional[Callable[[], None]]
+            If given we call this when napari exits, and do not reconnect.
+            So webmon can exit along with the napari that launched it.
+
+        Return
+        ------
+        Session
+            The new session.
+        """
+        self.remove(session_id)
+
+        bridge = NapariBridge(
+            self._socketio,
+            None,
+            room=session_id,
+            hitch_log=self._hitch_log,
+            capture=self._capture,
+        )
+        session = Session(session_id, config, bridge, source, on_shutdown)
+        self._sessions[session_id] = session
+        session.connect()
+
+        if self._started:
+            bridge.start_background_task()
+
+        LOGGER.info("Added session %s", session_id)
+        return session
+
+    def remove(self, session_id: str) -> bool:
+        """Remove a session, return True if it existed."""
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+
+        session.close()
+        LOGGER.info("Removed session %s", session_id)
+        return True
+
+    def get_bridge(self, session_id: str) -> Optional[NapariBridge]:
+        """Return the bridge for this session or None if no such session."""
+        session = self._sessions.get(session_id)
+        return None if session is None else session.bridge
+
+    def list(self) -> List[dict]:
+        """Return a description of every session."""
+        return [session.as_dict() for session in self._sessions.values()]
+
+    def client_metrics(self) -> dict:
+        """Return send queue metrics for every web client by session."""
+        return {
+            session_id: session.bridge.client_metrics()
+            for session_id, session in self._sessions.items()
+        }
+
+    def command_stats(self) -> dict:
+        """Return command latency histograms by session."""
+        return {
+            session_id: session.bridge.command_stats()
+            for session_id, session in self._sessions.items()
+        }
+
+    def memory(self) -> dict:
+        """Return the sizes of the data each session is holding."""
+        return {
+            session_id: session.bridge.memory()
+            for session_id, session in self._sessions.items()
+        }
+
+    def remove_client(self, sid: str, session_id: str) -> None:
+        """Forget this web client, it disconnected."""
+        bridge = self.get_bridge(session_id)
+        if bridge is not None:
+            bridge.remove_client(sid)
+
+    def start_background_task(self):
+        """Start every session's bridge and our monitor task.
+
+        Return
+        ------
+        Thread
+            A Thread-compatible object for the monitor task.
+        """
+        self._started = True
+        for session in self._sessions.values():
+            session.bridge.start_background_task()
+
+        return self._socketio.start_background_task(
+            target=self._monitor_task
+        )
+
+    def _monitor_task(self) -> None:
+        """Find new sessions and reconnect to disconnected ones."""
+        while True:
+            self._scan_sessions_dir()
+            self._reconnect()
+            self._socketio.sleep(MONITOR_INTERVAL_SECONDS)
+
+    def _reconnect(self) -> None:
+        """Try to reconnect every disconnected session."""
+        for session in list(self._sessions.values()):
+            if session.should_connect:
+                session.connect()
+
+    def _scan_sessions_dir(self) -> None:
+        """Add sessions for new config files, remove deleted ones."""
+        if self._sessions_dir is None:
+            return
+
+        found = {}
+        paths = list(Path(self._sessions_dir).glob("*.json"))
+        for path in paths:
+            try:
+                config = json.loads(path.read_text())
+            except (OSError, ValueError) as error:
+                LOGGER.error("Cannot read session %s: %s", path, error)
+                continue
+            if not isinstance(config, dict) or 'server_port' not in config:
+                LOGGER.error("Session %s has no server_port", path)
+                continue
+            found[path.stem] = config
+
+        for session_id, config in found.items():
+            session = self._sessions.get(session_id)
+            if session is None or session.config != config:
+                self.add(session_id, config, source="dir")
+
+        # Keep the session of a bad file, it might be half written.
+        present = {path.stem for path in paths}
+        for session_id, session in list(self._sessions.items()):
+            if session.source == "dir" and session_id not in present:
+                self.remove(session_id)
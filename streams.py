@@ -0,0 +1,346 @@
+"""StreamRegistry class.
+
+Napari announces each stream once with a "stream_schema" message:
+
+    {
+        "stream_schema": {
+            "name": "frame_time",
+            "kind": "event",
+            "fields": {"time": "f8", "delta_ms": "f4"}
+        }
+    }
+
+After that every message like {"frame_time": {...}} is data for that
+stream. We never look at what the data means, the schema tells us how to
+handle it:
+
+    event - Every value matters, like one frame time per frame. We buffer
+            the values in columns, one list per field. When the web client
+            asks for chart data we send each column as one binary array.
+
+    state - Only the latest value matters, like the current camera. Once a
+            tick we send the fields that changed since the last tick, and
+            every KEYFRAME_TICKS ticks we send all the fields, so clients
+            that joined late or dropped a delta catch up.
+
+A new napari metric only needs a new schema and the web page to show it.
+
+Streams that napari announced before it sent schemas are in BUILTIN_SCHEMAS.
+"""
+import logging
+from typing import Dict, List, Optional
+
+import numpy as np
+
+LOGGER = logging.getLogger("webmon")
+
+SCHEMA_KEY = "stream_schema"
+
+KIND_EVENT = "event"
+KIND_STATE = "state"
+
+# Send all the fields of a state stream this often.
+KEYFRAME_TICKS = 60
+
+BUILTIN_SCHEMAS = [
+    {
+        "name": "frame_time",
+        "kind": KIND_EVENT,
+        "fields": {"time": "f8", "delta_ms": "f8"},
+    },
+    {
+        "name": "load_chunk",
+        "kind": KIND_EVENT,
+        "fields": {"time": "f8", "load_ms": "f8", "num_bytes": "i8"},
+    },
+]
+
+
+class StreamSchema:
+    """The announced name, kind and fields of one stream.
+
+    Parameters
+    ----------
+    schema : dict
+        The body of a "stream_schema" message.
+    """
+
+    def __init__(self, schema: dict):
+        self.name: str = schema['name']
+        self.kind: str = schema.get('kind', KIND_EVENT)
+        self.fields: Dict[str, np.dtype] = {
+            field: np.dtype(dtype)
+            for field, dtype in schema.get('fields', {}).items()
+        }
+
+        if self.kind not in (KIND_EVENT, KIND_STATE):
+            raise ValueError(f"Stream {self.name} has bad kind {self.kind}")
+
+
+class EventStream:
+    """Buffers the values of an event stream in columns.
+
+    Parameters
+    ----------
+    schema : StreamSchema
+        The stream's schema.
+    """
+
+    def __init__(self, schema: StreamSchema):
+        self.schema = schema
+        self._columns: Dict[str, list] = {name: [] for name in schema.fields}
+        self._tap: Optional[Dict[str, list]] = None
+
+    def add(self, value: dict) -> None:
+        """Add one value, fields it's missing are filled with zero."""
+        for name, column in self._columns.items():
+            column.append(value.get(name, 0))
+
+        if self._tap is not None:
+            for name, column in self._tap.items():
+                column.append(value.get(name, 0))
+
+    def tap(self) -> None:
+        """Also buffer values for take_tap(), for server side analysis."""
+        if self._tap is None:
+            self._tap = {name: [] for name in self.schema.fields}
+
+    @property
+    def tapped(self) -> int:
+        """The number of values waiting for take_tap()."""
+        if self._tap is None:
+            return 0
+        return len(next(iter(self._tap.values()), []))
+
+    def take_tap(self) -> Dict[str, np.ndarray]:
+        """Return the values added since the last take_tap()."""
+        if self._tap is None:
+            return {}
+        return self._to_arrays(self._tap)
+
+    def __len__(self) -> int:
+        return len(next(iter(self._columns.values()), []))
+
+    def take(self) -> Dict[str, np.ndarray]:
+        """Return the buffered columns as arrays and start over."""
+        return self._to_arrays(self._columns)
+
+    def _to_arrays(self, columns: Dict[str, list]) -> Dict[str, np.ndarray]:
+        """Return the columns as arrays and clear them."""
+        arrays = {
+            name: np.asarray(column, dtype=self.schema.fields[name])
+            for name, column in columns.items()
+        }
+        for column in columns.values():
+            column.clear()
+        return arrays
+
+
+class StateStream:
+    """Latest value of a state stream, and what changed since last sent.
+
+    Parameters
+    ----------
+    schema : StreamSchema
+        The stream's schema.
+    """
+
+    def __init__(self, schema: StreamSchema):
+        self.schema = schema
+        self._latest: dict = {}
+        self._sent: dict = {}
+        self._dirty = False
+        self._ticks = 0
+
+    def add(self, value: dict) -> None:
+        """Replace the latest value."""
+        self._latest = value
+        self._dirty = True
+
+    def take_delta(self) -> Optional[dict]:
+        """Return the state to send this tick, or None if nothing changed.
+
+        Return
+        ------
+        Optional[dict]
+            {"full": bool, "data": fields}
+        """
+        self._ticks += 1
+        full = self._ticks % KEYFRAME_TICKS == 0
+        if not (self._dirty or full) or not self._latest:
+            return None
+
+        if full:
+            changed = dict(self._latest)
+        else:
+            changed = {
+                name: value
+                for name, value in self._latest.items()
+                if not _same(self._sent.get(name), value)
+            }
+
+        self._sent = dict(self._latest)
+        self._dirty = False
+        if not changed:
+            return None
+        return {"full": full, "data": changed}
+
+
+def _same(old, new) -> bool:
+    """Return True if the field value did not change."""
+    if isinstance(old, np.ndarray) or isinstance(new, np.ndarray):
+        return np.array_equal(old, new)
+    return old == new
+
+
+class StreamRegistry:
+    """All the streams napari announced.
+
+    Attributes
+    ----------
+    _events : Dict[str, EventStream]
+        Event streams by name.
+    _states : Dict[str, StateStream]
+        State streams by name.
+    """
+
+    def __init__(self):
+        self._events: Dict[str, EventStream] = {}
+        self._states: Dict[str, StateStream] = {}
+        self._taps = set()
+
+        for schema in BUILTIN_SCHEMAS:
+            self.register(schema)
+
+    def register(self, schema: dict) -> None:
+        """Register a stream, replacing any previous stream of that name.
+
+        Parameters
+        ----------
+        schema : dict
+            The body of a "stream_schema" message.
+        """
+        try:
+            stream_schema = StreamSchema(schema)
+        except (KeyError, TypeError, ValueError) as error:
+            LOGGER.error("Bad stream schema %s: %s", schema, error)
+            return
+
+        name = stream_schema.name
+        self._events.pop(name, None)
+        self._states.pop(name, None)
+
+        if stream_schema.kind == KIND_EVENT:
+            self._events[name] = EventStream(stream_schema)
+            if name in self._taps:
+                self._events[name].tap()
+        else:
+            self._states[name] = StateStream(stream_schema)
+        LOGGER.info("Registered %s stream %s", stream_schema.kind, name)
+
+    def add_message(self, message: dict) -> bool:
+        """If this is a schema or stream message handle it and return True.
+
+        Parameters
+        ----------
+        message : dict
+            A message from napari like {"frame_time": {"delta_ms": 16.7}}.
+        """
+        if SCHEMA_KEY in message:
+            self.register(message[SCHEMA_KEY])
+            return True
+
+        for name, value in message.items():
+            # Not "or", an EventStream with no values is falsy.
+            stream = self._events.get(name)
+            if stream is None:
+                stream = self._states.get(name)
+            if stream is not None and isinstance(value, dict):
+                stream.add(value)
+                return True
+
+        return False  # Not a stream message.
+
+    def tap(self, name: str) -> None:
+        """Buffer the event stream's values for take_tap() as well.
+
+        Parameters
+        ----------
+        name : str
+            The name of the event stream.
+        """
+        self._taps.add(name)
+        stream = self._events.get(name)
+        if stream is not None:
+            stream.tap()
+
+    def take_tap(self, name: str) -> Dict[str, np.ndarray]:
+        """Return the values added to the tapped stream since last time.
+
+        Parameters
+        ----------
+        name : str
+            The name of the event stream.
+        """
+        stream = self._events.get(name)
+        return {} if stream is None else stream.take_tap()
+
+    def take_events(self, binary: bool) -> dict:
+        """Return all buffered event values in columns and start over.
+
+        Parameters
+        ----------
+        binary : bool
+            If True each column is raw little-endian bytes, which socketio
+            sends as a binary attachment. Otherwise it's an ndarray.
+
+        Return
+        ------
+        dict
+            {name: {"length": int, "columns": {field: column}}}
+        """
+        payload = {}
+        for name, stream in self._events.items():
+            columns = stream.take()
+            length = len(next(iter(columns.values()), []))
+            if binary:
+                columns = {
+                    field: {
+                        "dtype": array.dtype.newbyteorder('<').str,
+                        "data": array.astype(
+                            array.dtype.newbyteorder('<'), copy=False
+                        ).tobytes(),
+                    }
+                    for field, array in columns.items()
+                }
+            payload[name] = {"length": length, "columns": columns}
+        return payload
+
+    def take_states(self) -> List[dict]:
+        """Return the state changes to send this tick.
+
+        Return
+        ------
+        List[dict]
+            One {"name": str, "full": bool, "data": fields} per stream.
+        """
+        changes = []
+        for name, stream in self._states.items():
+            delta = stream.take_delta()
+            if delta is not None:
+                changes.append({"name": name, **delta})
+        return changes
+
+    def counts(self) -> Dict[str, int]:
+        """Return the number of buffered values in each event stream."""
+        return {name: len(stream) for name, stream in self._events.items()}
+
+    def memory(self) -> dict:
+        """Return the number of values we are holding for each stream."""
+        return {
+            'events': {
+                name: {'values': len(stream), 'tapped': stream.tapped}
+                for name, stream in self._events.items()
+            },
+            'states': len(self._states),
+        }
@@ -0,0 +1,64 @@
+"""Tests for analyze.py on small synthetic captures."""
+import json
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from analyze import analyze, compare, run_analysis  # noqa: E402
+
+
+def _write_capture(path, sessions=("default",), frames=20_000, hitches=()):
+    """Write frame_time records at 60Hz, hitches are 200ms frames."""
+    with open(path, "w") as outfile:
+        for i in range(frames):
+            delta_ms = 200.0 if i in hitches else 16.7
+            for session in sessions:
+                record = {
+                    'session': session,
+                    'stream': "frame_time",
+                    'data': {'time': i / 60, 'delta_ms': delta_ms},
+                }
+                outfile.write(json.dumps(record) + "\n")
+
+
+def test_hitches_in_first_chunk_are_found(tmp_path):
+    capture = tmp_path / "capture.jsonl"
+    hitches = set(range(100, 20_000, 500))  # 40 hitches.
+    _write_capture(capture, hitches=hitches)
+
+    report = analyze(str(capture))
+    assert report['frames']['count'] == 20_000
+    assert report['frames']['hitches'] == len(hitches)
+
+
+def test_several_sessions_need_session(tmp_path):
+    capture = tmp_path / "capture.jsonl"
+    _write_capture(capture, sessions=("a", "b"), frames=100)
+
+    with pytest.raises(ValueError):
+        analyze(str(capture))
+    assert analyze(str(capture), "b")['frames']['count'] == 100
+
+
+def test_zero_baseline_is_valid_json(tmp_path):
+    capture = tmp_path / "capture.jsonl"
+    _write_capture(capture, frames=1000, hitches={500})
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(
+        json.dumps({'frames': {'hitches_per_1000_frames': 0.0}})
+    )
+    json_path = tmp_path / "report.json"
+
+    passed = run_analysis(str(capture), str(json_path), None, str(baseline))
+    assert not passed
+
+    check = json.loads(json_path.read_text())['baseline']['checks'][0]
+    assert check['regression_percent'] is None
+    assert check['passed'] is False
+
+
+def test_zero_baseline_no_regression():
+    report = {'frames': {'hitches_per_1000_frames': 0.0}}
+    [check] = compare(report, report, {})
+    assert check['passed']
@@ -0,0 +1,144 @@
+"""Tests for backpressure.py with a fake socketio server.
+
+The fake server has an engine.io socket per client whose queue only
+drains when the test says so, like a client on a slow link.
+"""
+import queue
+
+import pytest
+
+import backpressure
+from backpressure import (
+    DISCONNECT_SECONDS,
+    MAX_IN_FLIGHT,
+    MAX_PENDING_EVENTS,
+    ClientQueues,
+)
+
+
+class FakeSocket:
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def drain(self) -> list:
+        """The client received everything, return what it received."""
+        received = []
+        while not self.queue.empty():
+            received.append(self.queue.get())
+        return received
+
+
+class FakeEngineIO:
+    def __init__(self):
+        self.sockets = {}
+
+
+class FakeServer:
+    def __init__(self, *sids):
+        self.eio = FakeEngineIO()
+        self.disconnected = []
+        for sid in sids:
+            self.eio.sockets[sid] = FakeSocket()
+
+    def send(self, server, sid, encoded):
+        self.eio.sockets[sid].queue.put(encoded)
+
+    def disconnect(self, sid, namespace=None):
+        self.disconnected.append(sid)
+        del self.eio.sockets[sid]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(backpressure, "time", clock)
+    return clock
+
+
+def test_fast_client_gets_everything(clock):
+    server = FakeServer("fast")
+    queues = ClientQueues(server.send)
+
+    received = []
+    for i in range(100):
+        queues.put(server, "fast", "chart_data", str(i))
+        queues.flush(server)
+        received += server.eio.sockets["fast"].drain()
+
+    assert received == [str(i) for i in range(100)]
+    assert queues.metrics(server)["fast"]["dropped"] == 0
+
+
+def test_slow_client_does_not_hold_back_fast_client(clock):
+    server = FakeServer("fast", "slow")
+    queues = ClientQueues(server.send)
+
+    received = []
+    for i in range(100):
+        for sid in ("fast", "slow"):
+            queues.put(server, sid, "chart_data", str(i))
+        queues.flush(server)
+        received += server.eio.sockets["fast"].drain()
+
+    assert received == [str(i) for i in range(100)]
+
+    # The slow client never drained, so we only sent it MAX_IN_FLIGHT
+    # packets and kept the newest MAX_PENDING_EVENTS of the rest.
+    metrics = queues.metrics(server)["slow"]
+    assert metrics["depth"] == MAX_IN_FLIGHT
+    assert metrics["pending"] == MAX_PENDING_EVENTS
+    assert metrics["dropped"] == 100 - MAX_IN_FLIGHT - MAX_PENDING_EVENTS
+
+
+def test_latest_policy_keeps_newest_state(clock):
+    server = FakeServer("slow")
+    queues = ClientQueues(server.send)
+
+    for i in range(MAX_IN_FLIGHT + 10):
+        queues.put(server, "slow", "set_layer_data", i)
+
+    socket = server.eio.sockets["slow"]
+    assert socket.drain() == list(range(MAX_IN_FLIGHT))
+    queues.flush(server)
+    assert socket.drain() == [MAX_IN_FLIGHT + 9]
+
+
+def test_stalled_client_is_disconnected(clock):
+    server = FakeServer("fast", "stalled")
+    queues = ClientQueues(server.send)
+
+    # Both get frames for longer than DISCONNECT_SECONDS, but only the
+    # fast client reads them.
+    for _ in range(int(DISCONNECT_SECONDS * 10) + 10):
+        for sid in list(server.eio.sockets):
+            queues.put(server, sid, "chart_data", "frame")
+        queues.flush(server)
+        server.eio.sockets["fast"].drain()
+        clock.now += 0.1
+
+    assert server.disconnected == ["stalled"]
+    assert list(queues.metrics(server)) == ["fast"]
+
+
+def test_slow_but_moving_client_stays_connected(clock):
+    server = FakeServer("slow")
+    queues = ClientQueues(server.send)
+
+    # The client reads one packet a second, always behind but not stuck.
+    for tick in range(int(DISCONNECT_SECONDS * 10) * 3):
+        queues.put(server, "slow", "chart_data", "frame")
+        queues.flush(server)
+        if tick % 10 == 0:
+            server.eio.sockets["slow"].queue.get()
+        clock.now += 0.1
+
+    assert server.disconnected == []
+    assert queues.metrics(server)["slow"]["dropped"] > 0
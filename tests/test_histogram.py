@@ -0,0 +1,41 @@
+"""Tests for lib/histogram.py."""
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from lib.histogram import NUM_BUCKETS, Histogram  # noqa: E402
+
+
+def test_percentiles_within_bucket_width():
+    histogram = Histogram("test")
+    for value in range(1, 1001):
+        histogram.record(float(value))
+    assert histogram.percentile(50) == pytest.approx(500, rel=0.1)
+    assert histogram.percentile(99) == pytest.approx(990, rel=0.1)
+
+
+def test_record_many_matches_record():
+    values = np.array([0.0, 0.005, 1.0, 16.7, 250.0, 1e9])
+    one = Histogram("one")
+    for value in values:
+        one.record(float(value))
+    many = Histogram("many")
+    many.record_many(values)
+    assert one.counts == many.counts
+
+
+@pytest.mark.parametrize("value", [math.inf, 1e300])
+def test_huge_values_go_in_last_bucket(value):
+    histogram = Histogram("test")
+    histogram.record(value)
+    histogram.record_many(np.array([value]))
+    assert histogram.counts[NUM_BUCKETS - 1] == 2
+
+
+def test_nan_goes_in_first_bucket():
+    histogram = Histogram("test")
+    histogram.record(math.nan)
+    histogram.record_many(np.array([math.nan]))
+    assert histogram.counts[0] == 2
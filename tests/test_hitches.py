@@ -0,0 +1,75 @@
+"""Tests for hitches.py with synthetic frames and loads."""
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from hitches import MIN_BASELINE_FRAMES, HitchDetector  # noqa: E402
+
+FRAME_MS = 16.7
+
+
+def _frames(deltas_ms, start=0.0):
+    """Return frame_time columns, each frame ends at its time."""
+    deltas = np.asarray(deltas_ms, dtype=np.float64)
+    times = start + np.cumsum(deltas) / 1000
+    return {'time': times, 'delta_ms': deltas}
+
+
+def _loads(times, load_ms, num_bytes):
+    return {
+        'time': np.asarray(times, dtype=np.float64),
+        'load_ms': np.asarray(load_ms, dtype=np.float64),
+        'num_bytes': np.asarray(num_bytes, dtype=np.float64),
+    }
+
+
+def _baseline(detector):
+    """Give the detector a steady baseline, return the time it ends."""
+    frames = _frames([FRAME_MS] * MIN_BASELINE_FRAMES)
+    assert detector.process(frames, {}) == []
+    return float(frames['time'][-1])
+
+
+def test_spikes_attributed_to_overlapping_loads():
+    detector = HitchDetector()
+    start = _baseline(detector)
+
+    # Frames 2 and 5 are spikes, two loads overlap frame 2, none frame 5,
+    # a third load is before either.
+    deltas = [FRAME_MS, FRAME_MS, 200, FRAME_MS, FRAME_MS, 150, FRAME_MS]
+    frames = _frames(deltas, start)
+    spike_end = frames['time'][2]
+    loads = _loads(
+        [spike_end - 0.150, spike_end - 0.050, frames['time'][0]],
+        [120, 40, 10],
+        [1 << 20, 1 << 10, 1 << 5],
+    )
+
+    hitches = detector.process(frames, loads)
+    assert [h['delta_ms'] for h in hitches] == [200, 150]
+    assert detector.num_hitches == 2
+
+    first, second = hitches
+    assert first['num_loads'] == 2
+    assert first['load_bytes'] == (1 << 20) + (1 << 10)
+    assert first['max_load_ms'] == 120
+    assert first['median_ms'] == pytest.approx(FRAME_MS)
+
+    assert second['num_loads'] == 0
+    assert second['load_bytes'] == 0
+
+
+def test_needs_a_baseline():
+    detector = HitchDetector()
+    assert detector.process(_frames([FRAME_MS, 500]), {}) == []
+
+
+def test_missing_fields_are_skipped(caplog):
+    detector = HitchDetector()
+    start = _baseline(detector)
+
+    # Napari re-announced the streams without the fields we need.
+    frames = _frames([500], start)
+    assert detector.process({'delta_ms': frames['delta_ms']}, {}) == []
+    assert detector.process(frames, {'time': frames['time']}) != []
+    assert "load_chunk has no ['load_ms', 'num_bytes']" in caplog.text
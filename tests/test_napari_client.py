@@ -0,0 +1,167 @@
+"""Tests for napari_client.py with a napari whose IPC is slow.
+
+Every call on the SharedMemoryManager proxies is a round trip to napari.
+The bridge ticks at 60Hz on the eventlet hub, and must keep ticking on
+time no matter how slow those round trips are.
+"""
+import statistics
+import time
+from queue import Empty
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from napari_client import (  # noqa: E402
+    CLOCK_SYNC_KEY,
+    FEATURE_CLOCK_SYNC,
+    FEATURES_KEY,
+    NapariClient,
+    NapariRemoteAPI,
+)
+
+# Every call to napari takes this long.
+IPC_SECONDS = 0.05
+
+# The bridge's tick.
+TICK_SECONDS = 1 / 60
+
+# How late a tick may be.
+MAX_JITTER_SECONDS = 0.01
+
+
+class SlowDict:
+    """Stands in for the napari_data and client_data proxies."""
+
+    def __init__(self, data: dict):
+        self._data = data
+
+    def get(self, key, default=None):
+        time.sleep(IPC_SECONDS)
+        return self._data.get(key, default)
+
+
+class SlowQueue:
+    """Stands in for the napari_messages and client_messages proxies."""
+
+    def __init__(self):
+        self.items = []
+
+    def get_nowait(self):
+        time.sleep(IPC_SECONDS)
+        if not self.items:
+            raise Empty
+        return self.items.pop(0)
+
+    def put(self, item):
+        time.sleep(IPC_SECONDS)
+        self.items.append(item)
+
+
+class SlowEvent:
+    """Stands in for the napari_shutdown proxy."""
+
+    def is_set(self) -> bool:
+        time.sleep(IPC_SECONDS)
+        return False
+
+
+def _slow_connect(self):
+    time.sleep(IPC_SECONDS * 10)  # Napari is slow to accept too.
+    self._remote = NapariRemoteAPI(
+        SlowDict({'poll': {'layers': {}}}),
+        SlowQueue(),
+        SlowEvent(),
+        SlowDict({}),
+        SlowQueue(),
+    )
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(NapariClient, "_connect", _slow_connect)
+    client = NapariClient({'server_port': 0}, lambda: None)
+    yield client
+    client.stop()
+    client.join()
+
+
+def _wait_for_poll(client):
+    """Wait until the client connected and polled napari once."""
+    deadline = time.perf_counter() + 5
+    while client.get_napari_data("poll") is None:
+        assert time.perf_counter() < deadline, "Never polled napari."
+        time.sleep(TICK_SECONDS)
+
+
+def test_create_does_not_block(monkeypatch):
+    monkeypatch.setattr(NapariClient, "_connect", _slow_connect)
+    start = time.perf_counter()
+    client = NapariClient({'server_port': 0}, lambda: None)
+    elapsed = time.perf_counter() - start
+    client.stop()
+    client.join()
+    assert elapsed < IPC_SECONDS
+
+
+def test_connect_error_is_reported(monkeypatch):
+    def _refuse(self):
+        raise ConnectionRefusedError("napari is not there")
+
+    monkeypatch.setattr(NapariClient, "_connect", _refuse)
+    shutdowns = []
+    client = NapariClient({'server_port': 0}, lambda: shutdowns.append(1))
+    client.join()
+    assert isinstance(client.connect_error, ConnectionRefusedError)
+    assert shutdowns == []
+
+
+def test_slow_ipc_does_not_delay_ticks(client):
+    """Tick like the bridge does while the client waits on napari."""
+    _wait_for_poll(client)
+
+    lateness = []
+    next_tick = time.perf_counter()
+    for i in range(60):
+        client.get_napari_data("poll")
+        client.get_one_napari_message()
+        client.send_message({'test_command': {'index': i}})
+
+        next_tick += TICK_SECONDS
+        time.sleep(max(0, next_tick - time.perf_counter()))
+        lateness.append(time.perf_counter() - next_tick)
+
+    assert statistics.median(lateness) < MAX_JITTER_SECONDS
+    assert max(lateness) < IPC_SECONDS
+
+
+def test_clock_sync_waits_for_feature(client):
+    """Napari logs an error for every command it does not know."""
+    _wait_for_poll(client)
+    client_messages = client._remote.client_messages
+    assert not any(CLOCK_SYNC_KEY in msg for msg in client_messages.items)
+
+    client._remote.napari_messages.items.append(
+        {FEATURES_KEY: [FEATURE_CLOCK_SYNC]}
+    )
+    deadline = time.perf_counter() + 5
+    while not any(CLOCK_SYNC_KEY in msg for msg in client_messages.items):
+        assert time.perf_counter() < deadline, "Never sent clock_sync."
+        time.sleep(TICK_SECONDS)
+    assert client.features == {FEATURE_CLOCK_SYNC}
+
+
+def test_unexpected_error_still_shuts_down(monkeypatch):
+    def _broken_poll(self):
+        raise TypeError("buffer is too small")
+
+    monkeypatch.setattr(NapariClient, "_connect", _slow_connect)
+    monkeypatch.setattr(NapariClient, "_poll", _broken_poll)
+    monkeypatch.setattr(
+        "threading.excepthook", lambda args: None  # Expected, don't print.
+    )
+    shutdowns = []
+    client = NapariClient({'server_port': 0}, lambda: shutdowns.append(1))
+    client.join()
+    assert shutdowns == [1]
+    assert not client.is_alive()
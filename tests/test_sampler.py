@@ -0,0 +1,38 @@
+"""Tests for lib/sampler.py."""
+import threading
+import time
+
+import pytest
+
+from lib.sampler import Sampler
+
+
+def _busy(stop: threading.Event) -> None:
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_samples_other_threads():
+    stop = threading.Event()
+    worker = threading.Thread(target=_busy, args=(stop,), name="Busy")
+    worker.start()
+    try:
+        sampler = Sampler(rate_hz=200, seconds=0.2)
+        sampler.start()
+        sampler.join()
+    finally:
+        stop.set()
+        worker.join()
+
+    assert sampler.num_samples > 10
+    assert any(stack.startswith("Busy;") for stack in sampler.stacks)
+    assert not any(stack.startswith("Sampler;") for stack in sampler.stacks)
+    assert any("_busy" in f['function'] for f in sampler.summary())
+
+
+def test_one_profile_at_a_time():
+    first = Sampler(rate_hz=100, seconds=0.2)
+    first.start()
+    with pytest.raises(RuntimeError):
+        Sampler(rate_hz=100, seconds=0.2).start()
+    first.join()
@@ -0,0 +1,93 @@
+"""Tests for lib/shared_arrays.py with real SharedMemory segments."""
+import gc
+import sys
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from lib.shared_arrays import SharedArrays  # noqa: E402
+
+
+@pytest.fixture
+def segment():
+    """A segment holding 0..15 as int32, like one napari would create."""
+    segment = SharedMemory(create=True, size=16 * 4)
+    np.ndarray(16, dtype="<i4", buffer=segment.buf)[:] = np.arange(16)
+    yield segment
+    segment.close()
+    if sys.version_info < (3, 13):
+        # Attaching unregistered it, unlink() unregisters it again.
+        resource_tracker.register(segment._name, "shared_memory")
+    segment.unlink()
+
+
+def _descriptor(segment, generation=0) -> dict:
+    return {
+        'shared_array': {
+            'name': segment.name,
+            'dtype': '<i4',
+            'shape': [16],
+            'generation': generation,
+        }
+    }
+
+
+def test_same_descriptor_same_view(segment):
+    arrays = SharedArrays()
+    first = arrays.resolve({'tiles': _descriptor(segment)})
+    second = arrays.resolve({'tiles': _descriptor(segment)})
+    assert first['tiles'] is second['tiles']
+    assert list(first['tiles']) == list(range(16))
+    arrays.close()
+
+
+def test_view_outlives_descriptor(segment):
+    """A view held like NapariBridge._last_poll_data stays readable."""
+    arrays = SharedArrays()
+    view = arrays.resolve({'tiles': _descriptor(segment)})['tiles']
+    part = view[4:8]
+
+    arrays.resolve({})  # Napari dropped the segment.
+    assert arrays.as_dict()['closing'] == 1
+    assert list(part) == [4, 5, 6, 7]
+
+    del view
+    gc.collect()
+    arrays.resolve({})
+    assert arrays.as_dict()['closing'] == 1  # The slice still needs it.
+
+    del part
+    gc.collect()
+    arrays.resolve({})
+    assert arrays.as_dict()['closing'] == 0
+
+
+def test_old_generation_view_keeps_segment(segment):
+    arrays = SharedArrays()
+    old = arrays.resolve(_descriptor(segment, generation=1))
+    new = arrays.resolve(_descriptor(segment, generation=2))
+    assert old is not new
+
+    arrays.close()
+    assert arrays.as_dict()['closing'] == 1
+    assert old.sum() == new.sum() == sum(range(16))
+
+    del old, new
+    gc.collect()
+    arrays.close()
+    assert arrays.as_dict()['closing'] == 0
+
+
+@pytest.mark.parametrize(
+    "dtype, shape",
+    [("<i4", [17]), ("<f8", [16]), ("<i4", [-1]), ("not a dtype", [1])],
+)
+def test_descriptor_must_fit_segment(segment, dtype, shape):
+    arrays = SharedArrays()
+    desc = _descriptor(segment)
+    desc['shared_array'].update(dtype=dtype, shape=shape)
+    assert arrays.resolve({'tiles': desc}) == {'tiles': None}
+    arrays.close()
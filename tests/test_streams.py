@@ -0,0 +1,76 @@
+"""Tests for streams.py, messages in and payloads out."""
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from streams import KEYFRAME_TICKS, SCHEMA_KEY, StreamRegistry  # noqa: E402
+
+
+def test_builtin_event_stream():
+    registry = StreamRegistry()
+    for i in range(5):
+        message = {'frame_time': {'time': i / 60, 'delta_ms': 16.7}}
+        assert registry.add_message(message)
+
+    assert registry.counts()['frame_time'] == 5
+    columns = registry.take_events(binary=False)['frame_time']
+    assert columns['length'] == 5
+    assert list(columns['columns']['delta_ms']) == [16.7] * 5
+
+    # Taking emptied the stream, it must still take more values.
+    assert registry.add_message({'frame_time': {'delta_ms': 33.4}})
+    assert registry.counts()['frame_time'] == 1
+
+
+def test_binary_columns():
+    registry = StreamRegistry()
+    registry.add_message({'load_chunk': {'time': 1.0, 'num_bytes': 1024}})
+    column = registry.take_events(binary=True)['load_chunk']['columns']
+    num_bytes = column['num_bytes']
+    assert num_bytes['dtype'] == '<i8'
+    assert np.frombuffer(num_bytes['data'], '<i8').tolist() == [1024]
+
+
+def test_announced_event_stream():
+    registry = StreamRegistry()
+    schema = {'name': 'paint', 'kind': 'event', 'fields': {'x': 'i4'}}
+    assert registry.add_message({SCHEMA_KEY: schema})
+    assert registry.add_message({'paint': {'x': 3}})
+    columns = registry.take_events(binary=False)['paint']['columns']
+    assert columns['x'].dtype == np.int32
+    assert list(columns['x']) == [3]
+
+
+def test_state_stream_deltas():
+    registry = StreamRegistry()
+    schema = {'name': 'camera', 'kind': 'state'}
+    registry.add_message({SCHEMA_KEY: schema})
+
+    registry.add_message({'camera': {'zoom': 1.0, 'center': [0, 0]}})
+    [state] = registry.take_states()
+    assert state['name'] == 'camera'
+    assert state['data'] == {'zoom': 1.0, 'center': [0, 0]}
+
+    registry.add_message({'camera': {'zoom': 2.0, 'center': [0, 0]}})
+    [state] = registry.take_states()
+    assert state['data'] == {'zoom': 2.0}
+    assert not state['full']
+
+    assert registry.take_states() == []  # Nothing changed.
+
+
+def test_state_stream_keyframe():
+    registry = StreamRegistry()
+    registry.add_message({SCHEMA_KEY: {'name': 'camera', 'kind': 'state'}})
+    registry.add_message({'camera': {'zoom': 1.0}})
+
+    states = [registry.take_states() for _ in range(KEYFRAME_TICKS)]
+    keyframes = [s for s in states if s and s[0]['full']]
+    assert len(keyframes) == 1
+    assert keyframes[0][0]['data'] == {'zoom': 1.0}
+
+
+def test_not_a_stream_message():
+    registry = StreamRegistry()
+    assert not registry.add_message({'show_grid': True})
+    assert not registry.add_message({'unknown_stream': {'x': 1}})
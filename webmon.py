@@ -8,26 +8,64 @@ https://github.com/pwinston/webmon
 1) Start socketio web server, default localhost:5000.
 2) Start NapariClient which connects to napari via shared memory.
 
+With --role ingest/worker webmon runs in fan-out mode instead, see
+fanout.py for details.
+
 History
 -------
 Originally based on:
 https://github.com/ageller/FlaskTest
 """
+import sys
+
+
+def _is_worker(argv) -> bool:
+    """Return True if we were started with --role worker."""
+    return any(
+        arg == "--role=worker" or (arg == "--role" and value == "worker")
+        for arg, value in zip(argv, argv[1:] + [""])
+    )
+
+
+# A worker reads the message queue with the Redis or Kombu client, which
+# only cooperate with eventlet if the socket library is monkey patched. It
+# has to be patched before anything else imports socket or threading.
+if _is_worker(sys.argv):
+    import eventlet
+
+    eventlet.monkey_patch()
+
 import logging
 import os
-import sys
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
 import click
-import requests
-from flask import Flask, abort, render_template
+from flask import (
+    Flask,
+    Response,
+    abort,
+    jsonify,
+    render_template,
+    request,
+)
 from flask_socketio import SocketIO
 
-from bridge import NapariBridge
+from capture import Capture
+from fanout import (
+    COMMAND_SOCKET,
+    WorkerBridge,
+    create_relay_manager,
+    run_ingest,
+)
 from handlers import WebmonHandlers
+from hitches import HitchLog
 from lib.logging import setup_logging
+from lib.memory import AllocationTracker, peak_rss_bytes
 from lib.numpy_json import NumpyJSON
-from napari_client import NapariClient
+from lib.static_assets import StaticAssets
+from lib.sampler import DEFAULT_RATE_HZ, Sampler
+from napari_client import NapariClient, get_client_config
+from sessions import DEFAULT_SESSION, SessionPool
 
 LOGGER = logging.getLogger("webmon")
 
@@ -44,9 +82,10 @@ CREATE_CLIENT = True
 # run a 2nd process, we could turn this back on.
 USE_RELOADER = False
 
-# Flask.
-app = Flask(__name__)
+# Flask. We serve the static files ourselves, see lib/static_assets.py.
+app = Flask(__name__, static_folder=None)
 app.config['SECRET_KEY'] = 'secret!'
+assets = StaticAssets(os.path.join(app.root_path, "static"))
 
 # Eventlet
 # --------
@@ -54,27 +93,55 @@ app.config['SECRET_KEY'] = 'secret!'
 # eventlet developer says it's really intended for 100's of simultaneous
 # connections! So maybe it is overkill. But what else should we use?
 #
-# Note that we don't call eventlet.monkey_patch(). It patches various
-# standard library functions to be "green" compatible. But it causes
-# a crash today with SharedMemoryManager:
+# Standalone and ingest webmon don't call eventlet.monkey_patch(). It
+# patches various standard library functions to be "green" compatible.
+# But it causes a crash today with SharedMemoryManager:
 #
 # https://github.com/eventlet/eventlet/issues/670
 #
-# And monkey_patch() doesn't seem to be necessary for us?
+# Workers never touch SharedMemoryManager, and their message queue client
+# needs the patched socket library, so workers do call it, see the top of
+# this file.
 ASYNC_MODE = "eventlet"
 
-# Flask-SocketIO.
-socketio = SocketIO(app, async_mode=ASYNC_MODE, json=NumpyJSON)
+# Flask-SocketIO. We call init_app() in main once we know if we are using
+# a message queue.
+socketio = SocketIO(json=NumpyJSON)
+
+# Roles for --role. A "standalone" webmon does everything itself, while
+# "ingest" and "worker" processes split the work in fan-out mode.
+ROLES = ["standalone", "ingest", "worker"]
 
 pages = ["viewer", "loader"]
 
+# Traces allocations only while someone is looking for a leak.
+allocations = AllocationTracker()
+
+
+@app.context_processor
+def asset_urls():
+    """Templates link to static files with asset_url('viewer.js')."""
+    return dict(asset_url=assets.url)
+
+
+@app.route('/static/<path:filename>')
+def static_file(filename):
+    """Serve a static file compressed, with caching headers."""
+    response = assets.response(filename, request, app.response_class)
+    if response is None:
+        abort(404)
+    return response
+
 
 @app.route('/<page_name>')
 def show_page(page_name):
     if page_name in pages:
+        # Keep the same napari session as we move between pages.
+        session_id = request.args.get('session')
+        query = "" if session_id is None else f"?session={session_id}"
         routes = [
             dict(
-                href=f"/{page}",
+                href=f"/{page}{query}",
                 name=page.capitalize(),
                 active=page == page_name,
             )
@@ -98,6 +165,116 @@ def stop():
     return "<h1>Stop</h1>Stopped socketio."
 
 
+@app.route("/stats/clients")
+def client_stats():
+    """Send queue depth and drop counts for every web client."""
+    return jsonify(sessions.client_metrics())
+
+
+@app.route("/stats/commands")
+def command_stats():
+    """Command round trip latency histograms for every session."""
+    return jsonify(sessions.command_stats())
+
+
+@app.route("/profile")
+def profile():
+    """Sample the stacks of webmon's threads for a while.
+
+    Returns a per-function summary and the collapsed stacks as JSON, or
+    with format=collapsed only the collapsed stacks as flamegraph input:
+
+        curl 'localhost:5000/profile?seconds=5&rate=200&format=collapsed' \\
+            | flamegraph.pl > webmon.svg
+    """
+    seconds = request.args.get('seconds', 5, type=float)
+    rate_hz = request.args.get('rate', DEFAULT_RATE_HZ, type=float)
+    try:
+        sampler = Sampler(rate_hz, seconds)
+        sampler.start()
+    except ValueError:
+        abort(400)
+    except RuntimeError:
+        abort(409)  # Already profiling.
+
+    # The sampler is a real thread, let the green threads run meanwhile
+    # so we profile them and not us waiting.
+    while sampler.is_alive():
+        socketio.sleep(0.1)
+
+    if request.args.get('format') == "collapsed":
+        return Response("\n".join(sampler.collapsed()), mimetype="text/plain")
+    return jsonify(sampler.as_dict())
+
+
+@app.route("/memory")
+def memory():
+    """Sizes of the buffers, queues and outboxes of every session."""
+    return jsonify(
+        {
+            'peak_rss_bytes': peak_rss_bytes(),
+            'tracing': allocations.tracing,
+            'sessions': sessions.memory(),
+        }
+    )
+
+
+@app.route("/memory/trace", methods=["GET", "PUT", "DELETE"])
+def trace_memory():
+    """Trace allocations with tracemalloc, grouped by module.
+
+    PUT starts tracing and DELETE stops it. Each GET takes a snapshot and
+    returns the modules which grew the most since the previous GET:
+
+        curl -X PUT localhost:5000/memory/trace
+        curl localhost:5000/memory/trace
+        curl 'localhost:5000/memory/trace?limit=10&depth=1'
+    """
+    if request.method == "PUT":
+        allocations.start(request.args.get('frames', 1, type=int))
+        return jsonify({'tracing': True})
+
+    if request.method == "DELETE":
+        allocations.stop()
+        return jsonify({'tracing': False})
+
+    try:
+        return jsonify(
+            allocations.take(
+                limit=request.args.get('limit', 20, type=int),
+                depth=request.args.get('depth', 2, type=int),
+            )
+        )
+    except RuntimeError:
+        abort(409)  # Not tracing.
+
+
+@app.route("/sessions")
+def list_sessions():
+    """List the napari sessions we are monitoring."""
+    return jsonify(sessions.list())
+
+
+@app.route("/sessions/<session_id>", methods=["PUT", "DELETE"])
+def change_session(session_id):
+    """Add a session with a PUT of its config, or remove it with DELETE.
+
+    The config is the same JSON napari puts in NAPARI_MON_CLIENT, like:
+
+        curl -X PUT -H "Content-Type: application/json" \\
+            -d '{"server_port": 52345}' localhost:5000/sessions/napari2
+    """
+    if request.method == "DELETE":
+        if not sessions.remove(session_id):
+            abort(404)
+        return jsonify({'removed': session_id})
+
+    config = request.get_json(silent=True)
+    if not isinstance(config, dict) or 'server_port' not in config:
+        abort(400)
+    return jsonify(sessions.add(session_id, config).as_dict())
+
+
 def _notify_stop(port: int) -> None:
     """Shutdown the web server.
 
@@ -105,6 +282,8 @@ def _notify_stop(port: int) -> None:
     when it detects the napari it was connected to shuts down. So
     we call our /stop endpoint to shutdown socketio.
     """
+    import requests  # Only needed at exit, so don't slow down startup.
+
     stop_url = f"http://localhost:{port}/stop"
     try:
         requests.get(stop_url)
@@ -112,21 +291,15 @@ def _notify_stop(port: int) -> None:
         LOGGER.error("Webmon: requests.exceptions.ConnectionError")
 
 
-def _create_napari_client(port: int):
-    """Create and return the NapariClient.
-
-    Parameters
-    ----------
-    port : int
-        The port number of the web server.
-    """
+def _create_napari_client():
+    """Create and return the NapariClient for the ingest process."""
     if not CREATE_CLIENT:
         LOGGER.error("NapariClient not created, CREATE_CLIENT=False.")
         return None
 
     def _on_shutdown() -> None:
-        """Hit endpoint /stop."""
-        _notify_stop(port)
+        """The ingest process exits once the client exits."""
+        LOGGER.info("Webmon: NapariClient shut down.")
 
     # Create the client.
     client = NapariClient.create(_on_shutdown)
@@ -137,30 +310,163 @@ def _create_napari_client(port: int):
     return client
 
 
-@click.command()
+def _create_sessions(
+    port: int,
+    sessions_dir: Optional[str],
+    hitch_log: Optional[HitchLog],
+    capture: Optional[Capture],
+) -> SessionPool:
+    """Create the SessionPool, with the napari that launched us if any.
+
+    Parameters
+    ----------
+    port : int
+        The port number of the web server.
+    sessions_dir : Optional[str]
+        Directory of session config files.
+    hitch_log : Optional[HitchLog]
+        Write the hitches of every session to this log.
+    capture : Optional[Capture]
+        Record the streams of every session to this capture.
+    """
+    pool = SessionPool(socketio, sessions_dir, hitch_log, capture)
+
+    if not CREATE_CLIENT:
+        LOGGER.error("NapariClient not created, CREATE_CLIENT=False.")
+        return pool
+
+    config = get_client_config()
+    if config is None:
+        LOGGER.info("No napari launched us, no %s session.", DEFAULT_SESSION)
+        return pool
+
+    def _on_shutdown() -> None:
+        """Hit endpoint /stop, unless we are monitoring other sessions."""
+        others = [
+            session['session_id']
+            for session in pool.list()
+            if session['session_id'] != DEFAULT_SESSION
+        ]
+        if others:
+            LOGGER.info("Webmon: napari exited, still monitoring %s", others)
+            return
+        _notify_stop(port)
+
+    # Without a sessions_dir we exit along with the napari that launched
+    # us, unless sessions were added with PUT /sessions/<id>. With a
+    # sessions_dir we keep running to monitor other sessions.
+    on_shutdown = None if sessions_dir else _on_shutdown
+    pool.add(DEFAULT_SESSION, config, source="env", on_shutdown=on_shutdown)
+    return pool
+
+
+@click.group(invoke_without_command=True)
+@click.pass_context
 @click.option('--log_path', default=None, help="Path to write the log file")
 @click.option('--port', default=5000, help="Port for HTTP server")
-def main(log_path: Optional[str], port: int) -> None:
+@click.option(
+    '--role',
+    type=click.Choice(ROLES),
+    default="standalone",
+    help="Run standalone, or as the ingest or a worker process",
+)
+@click.option(
+    '--message_queue',
+    default=None,
+    help="Message queue URL for fan-out mode like redis://localhost:6379/0",
+)
+@click.option(
+    '--command_socket',
+    default=COMMAND_SOCKET,
+    help="Unix socket for commands in fan-out mode",
+)
+@click.option(
+    '--sessions_dir',
+    default=None,
+    help="Directory of <session_id>.json configs for napari sessions",
+)
+@click.option(
+    '--hitch_log',
+    default=None,
+    help="Path to append detected frame hitches to as JSON lines",
+)
+@click.option(
+    '--capture_path',
+    default=None,
+    help="Path to record napari's streams to, for the analyze command",
+)
+def main(
+    ctx: click.Context,
+    log_path: Optional[str],
+    port: int,
+    role: str,
+    message_queue: Optional[str],
+    command_socket: str,
+    sessions_dir: Optional[str],
+    hitch_log: Optional[str],
+    capture_path: Optional[str],
+) -> None:
     """Start webmon and the NapariClient.
 
+    Without a command we serve, see "analyze --help" for the other command.
+
     Parameters
     log_path : Optional[str]
         If defined write the log to this path.
     port : int
         Serve HTTP at this port.
+    role : str
+        One of ROLES.
+    message_queue : Optional[str]
+        The message queue used in fan-out mode.
+    command_socket : str
+        The Unix socket path used for commands in fan-out mode.
+    sessions_dir : Optional[str]
+        Directory of session config files to monitor.
+    hitch_log : Optional[str]
+        If defined append detected frame hitches to this path.
+    capture_path : Optional[str]
+        If defined record napari's streams to this path.
     """
+    global sessions
+    if ctx.invoked_subcommand is not None:
+        return  # Run the command instead of serving.
+
     setup_logging(log_path)
 
     LOGGER.info("Webmon: Starting process %d", os.getpid())
     LOGGER.info("Webmon: args %s", sys.argv)
-    LOGGER.info("Webmon: Serving http://localhost:%d/ ", port)
 
-    global client
-    client = _create_napari_client(port)
+    if role != "standalone" and message_queue is None:
+        raise click.UsageError(f"--role {role} requires --message_queue")
 
-    bridge = NapariBridge(socketio, client)
+    hitches = None if hitch_log is None else HitchLog(hitch_log)
+    capture = None if capture_path is None else Capture(capture_path)
 
-    socketio.on_namespace(WebmonHandlers(bridge, '/test'))
+    if role == "ingest":
+        client = _create_napari_client()
+        if client is not None:
+            run_ingest(
+                client, message_queue, command_socket, hitches, capture
+            )
+        LOGGER.info("Webmon: exiting process %s...", os.getpid())
+        return
+
+    LOGGER.info("Webmon: Serving http://localhost:%d/ ", port)
+    if role == "worker":
+        sessions = WorkerBridge(socketio, command_socket)
+        socketio.init_app(
+            app,
+            async_mode=ASYNC_MODE,
+            client_manager=create_relay_manager(
+                message_queue, sessions.broadcaster
+            ),
+        )
+    else:
+        socketio.init_app(app, async_mode=ASYNC_MODE)
+        sessions = _create_sessions(port, sessions_dir, hitches, capture)
+
+    socketio.on_namespace(WebmonHandlers(sessions, '/test'))
 
     # socketio.run does not exit until our /stop endpoint is hit.
     socketio.run(
@@ -170,5 +476,71 @@ def main(log_path: Optional[str], port: int) -> None:
     LOGGER.info("Webmon: exiting process %s...", os.getpid())
 
 
+def _parse_thresholds(thresholds: Tuple[str, ...]) -> Dict[str, float]:
+    """Parse "metric=percent" strings into a dict."""
+    parsed = {}
+    for threshold in thresholds:
+        name, _, percent = threshold.partition("=")
+        try:
+            parsed[name] = float(percent)
+        except ValueError:
+            raise click.BadParameter(
+                f"{threshold} is not metric=percent", param_hint="--threshold"
+            )
+    return parsed
+
+
+@main.command()
+@click.argument('capture_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--json_path', default=None, help="Path to write the report")
+@click.option('--html_path', default=None, help="Path to write HTML report")
+@click.option(
+    '--baseline',
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="Report of an earlier run to compare against",
+)
+@click.option(
+    '--max_regression',
+    default=None,
+    type=float,
+    help="Fail if a metric is this many percent worse than the baseline",
+)
+@click.option(
+    '--threshold',
+    multiple=True,
+    help="Max regression for one metric like frame_ms.p99=20",
+)
+@click.option('--session', default=None, help="Only analyze this session")
+def analyze(
+    capture_path: str,
+    json_path: Optional[str],
+    html_path: Optional[str],
+    baseline: Optional[str],
+    max_regression: Optional[float],
+    threshold: Tuple[str, ...],
+    session: Optional[str],
+) -> None:
+    """Report on a capture, and compare it against a baseline.
+
+    Exits with status 1 if a metric regressed more than its threshold.
+    """
+    # Serving never needs the analysis code.
+    from analyze import DEFAULT_MAX_REGRESSION, METRICS, run_analysis
+
+    if max_regression is None:
+        max_regression = DEFAULT_MAX_REGRESSION
+    thresholds = {name: max_regression for name, _, _ in METRICS}
+    thresholds.update(_parse_thresholds(threshold))
+
+    try:
+        passed = run_analysis(
+            capture_path, json_path, html_path, baseline, thresholds, session
+        )
+    except ValueError as error:  # Several sessions and no --session.
+        raise click.UsageError(str(error))
+    sys.exit(0 if passed else 1)
+
+
 if __name__ == "__main__":
     main()